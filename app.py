@@ -1,469 +1,1267 @@
 import os
-import cv2
+import re
+import gzip
+import json
+import math
+import codecs
+import fcntl
+import atexit
+import sqlite3
+import bisect
+import queue
+import shutil
+import subprocess
+import hashlib
+import base64
+import threading
+import sys
+import time
+import logging
 import mimetypes
+import multiprocessing
+import media
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as MediaTimeout
+from concurrent.futures.process import BrokenProcessPool
+from collections import OrderedDict, deque
 from urllib.parse import quote, unquote
-from flask import Flask, send_from_directory, render_template_string, abort, Response, Blueprint, request, send_file
-
-app = Flask(__name__)
-BASE_DIR = os.path.join("/app/anime_library")
+try:
+    import brotli
+except ImportError:
+    brotli = None
+from markupsafe import Markup
+from flask import Flask, send_from_directory, render_template, abort, Response, Blueprint, request, send_file, jsonify, g
+
+app = Flask(__name__, static_folder=None)
+
+log = logging.getLogger(__name__)
+gunicorn_log = logging.getLogger('gunicorn.error')
+if gunicorn_log.handlers:
+    # Under gunicorn, background failures go to its errorlog with level and timestamp
+    log.handlers = gunicorn_log.handlers
+    log.setLevel(gunicorn_log.level)
+    log.propagate = False
+BASE_DIR = os.environ.get("ANISUB_LIBRARY", "/app/anime_library")
 BASE_PATH = "/侍の道"
+CACHE_DIR = os.environ.get("ANISUB_CACHE_DIR", "/app/cache")
+
+# Seek-preview sprite sheets (one tile every THUMB_INTERVAL seconds)
+THUMB_INTERVAL = int(os.environ.get("ANISUB_THUMB_INTERVAL", 10))
+THUMB_WIDTH = 180
+SPRITE_COLS, SPRITE_ROWS = 10, 10
+
+# At most this many previews decode at once; the rest get a quick 503 instead of
+# tying up request threads that page loads and streams need
+PREVIEW_MAX_CONCURRENCY = int(os.environ.get("ANISUB_PREVIEW_MAX_CONCURRENCY", 4))
+# OpenCV work (media.py) runs in this many separate processes, so HTTP workers never
+# load it; 0 runs it in-process, importing OpenCV on the first preview/sprite/poster
+PREVIEW_WORKERS = int(os.environ.get("ANISUB_PREVIEW_WORKERS", 0))
+# Interactive calls into those workers (previews, posters, probes) give up after this long
+MEDIA_TIMEOUT = float(os.environ.get("ANISUB_MEDIA_TIMEOUT", 10))
+# Previews snap to the nearest keyframe (from a per-episode ffprobe index) so every hover
+# is one short decode; rendered keyframes are kept in memory up to KEYFRAME_CACHE_BYTES
+FFPROBE = os.environ.get("ANISUB_FFPROBE", "ffprobe")
+KEYFRAME_CACHE_BYTES = int(os.environ.get("ANISUB_KEYFRAME_CACHE_BYTES", 64 * 1024 * 1024))
+
+# Poster thumbnails, matching the grid's minmax(160px/220px) columns
+POSTER_WIDTHS = (220, 440)
+POSTER_SIZES = "(min-width: 768px) 260px, 50vw"
+
+# Library index (rescans only directories whose mtime changed)
+VIDEO_EXTS = ('.mkv', '.mp4', '.webm')
+POSTER_EXTS = ('.jpg', '.jpeg', '.png', '.webp')
+POSSIBLE_RES = ['240p', '360p', '480p', '720p', '1080p']
+INDEX_POLL_INTERVAL = int(os.environ.get("ANISUB_INDEX_POLL_INTERVAL", 30))
+
+# Library grid and JSON API page size (the grid loads further pages while scrolling)
+PAGE_SIZE = int(os.environ.get("ANISUB_PAGE_SIZE", 60))
+MAX_PAGE_SIZE = 200
+
+# Video streaming: 'sendfile' hands the open file to the WSGI server's file_wrapper
+# (gunicorn uses os.sendfile), 'x-accel-redirect' (nginx) and 'x-sendfile'
+# (apache/lighttpd) let the front-end proxy serve the bytes itself.
+STREAM_OFFLOAD = os.environ.get("ANISUB_STREAM_OFFLOAD", "sendfile")
+STREAM_ACCEL_PREFIX = os.environ.get("ANISUB_ACCEL_PREFIX", "/_anime_library")
+STREAM_CHUNK = 1024 * 1024
+STREAM_READAHEAD = int(os.environ.get("ANISUB_STREAM_READAHEAD", 8 * 1024 * 1024))
+STREAM_MAX_RANGES = 16
+# Open-ended ranges ("bytes=N-") are answered with at most this many bytes, so a
+# slow viewer doesn't hold a worker thread for the whole episode; players simply
+# request the next range. 0 disables the cap.
+STREAM_RANGE_CAP = int(os.environ.get("ANISUB_STREAM_RANGE_CAP", 16 * 1024 * 1024))
+# Stream throttling (bytes/s, 0 = unlimited): a global egress cap and a per-client cap that
+# can be overridden per resolution folder ("240p=150000,1080p=2500000"). The first
+# STREAM_PLAYBACK_WINDOW bytes of every response are what the player is waiting on and go
+# ahead of the rest (read-ahead). Clients are told apart by STREAM_CLIENT_HEADER (e.g.
+# X-Forwarded-For behind a proxy) or the peer address, and may have at most
+# STREAM_MAX_PER_CLIENT open streams (0 = unlimited).
+STREAM_EGRESS_LIMIT = int(os.environ.get("ANISUB_STREAM_EGRESS_LIMIT", 0))
+STREAM_CLIENT_LIMIT = int(os.environ.get("ANISUB_STREAM_CLIENT_LIMIT", 0))
+STREAM_CLIENT_LIMITS = {res: int(rate) for res, _, rate in (item.partition('=') for item in
+                        os.environ.get("ANISUB_STREAM_CLIENT_LIMITS", "").split(',') if item) if rate}
+STREAM_MAX_PER_CLIENT = int(os.environ.get("ANISUB_STREAM_MAX_PER_CLIENT", 0))
+STREAM_CLIENT_HEADER = os.environ.get("ANISUB_CLIENT_HEADER", "")
+STREAM_PLAYBACK_WINDOW = int(os.environ.get("ANISUB_STREAM_PLAYBACK_WINDOW", 2 * 1024 * 1024))
+STREAM_BURST_SECONDS = 2
+STREAM_THROTTLE_CHUNK = 64 * 1024
+
+# Adaptive HLS: renditions are remuxed (no re-encode) with ffmpeg on first request
+FFMPEG = os.environ.get("ANISUB_FFMPEG", "ffmpeg")
+HLS_SEGMENT_SECONDS = int(os.environ.get("ANISUB_HLS_SEGMENT_SECONDS", 6))
+HLS_CACHE_BYTES = int(os.environ.get("ANISUB_HLS_CACHE_BYTES", 20 * 1024 ** 3))
+HLS_MAX_JOBS = int(os.environ.get("ANISUB_HLS_MAX_JOBS", 2))
+
+# Background transcoding of missing renditions into <show>/<res>/ (empty targets disables it)
+TRANSCODE_TARGETS = [r for r in os.environ.get("ANISUB_TRANSCODE_TARGETS", "480p,720p").split(',') if r in POSSIBLE_RES]
+TRANSCODE_WORKERS = int(os.environ.get("ANISUB_TRANSCODE_WORKERS", 1))
+TRANSCODE_NICE = int(os.environ.get("ANISUB_TRANSCODE_NICE", 10))
+TRANSCODE_SCAN_INTERVAL = int(os.environ.get("ANISUB_TRANSCODE_SCAN_INTERVAL", 600))
+
+# Watch progress (SQLite, WAL); heartbeats are coalesced in memory and flushed in batches
+PROGRESS_DB = os.environ.get("ANISUB_PROGRESS_DB", os.path.join(CACHE_DIR, "progress.db"))
+PROGRESS_FLUSH_INTERVAL = float(os.environ.get("ANISUB_PROGRESS_FLUSH_INTERVAL", 5))
+CONTINUE_WATCHING_LIMIT = 12
+
+# Next-episode warmup once playback passes PREFETCH_AT (fraction of the episode; 0 disables):
+# the first PREFETCH_BYTES of its stream are read ahead into the page cache
+PREFETCH_AT = float(os.environ.get("ANISUB_PREFETCH_AT", 0.75))
+PREFETCH_BYTES = int(os.environ.get("ANISUB_PREFETCH_BYTES", 32 * 1024 * 1024))
+
+# Metrics (/metrics, Prometheus text format) and the optional sampling profiler
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+PROFILER_ENABLED = os.environ.get("ANISUB_PROFILER", "") not in ("", "0")
+PROFILER_INTERVAL = float(os.environ.get("ANISUB_PROFILER_INTERVAL", 0.005))
+
+# Converted subtitles (SRT -> WebVTT), kept in memory up to SUB_CACHE_BYTES
+SUB_CACHE_BYTES = int(os.environ.get("ANISUB_SUB_CACHE_BYTES", 32 * 1024 * 1024))
+SUB_ENCODINGS = os.environ.get("ANISUB_SUB_ENCODINGS", "utf-8,cp1251,cp1252").split(',')
+# Embedded text subtitle tracks are extracted to WebVTT in the background, one file at a
+# time, waiting while more than SUB_EXTRACT_MAX_STREAMS streams are open in this process
+SUB_EXTRACT_MAX_STREAMS = int(os.environ.get("ANISUB_SUB_EXTRACT_MAX_STREAMS", 4))
+TEXT_SUB_CODECS = ('ass', 'ssa', 'subrip', 'srt', 'webvtt', 'mov_text', 'text')
 
 # Blueprint for the anime sub-application
 anisub_bp = Blueprint('anisub', __name__, url_prefix=BASE_PATH)
 
-preview_caps = {}
-
-# --- GLOBAL STYLES ---
-KODI_STYLE = """
-<style>
-    :root { --bg: #0f0f0f; --card-bg: #1a1a1a; --text: #efefef; --accent: #00d1b2; --mobile-gap: 12px; }
-    body { background-color: var(--bg); color: var(--text); font-family: 'Inter', sans-serif; margin: 0; padding: 0; overflow-x: hidden; -webkit-tap-highlight-color: transparent; }
-    h1, h2 { font-weight: 300; color: var(--accent); margin-left: 10px; }
-    .grid { display: grid; grid-template-columns: repeat(auto-fill, minmax(160px, 1fr)); gap: 20px; padding: 15px; }
-
-    @media (min-width: 768px) {
-        .grid { grid-template-columns: repeat(auto-fill, minmax(220px, 1fr)); gap: 25px; }
-    }
-
-    .card { background: var(--card-bg); border-radius: 12px; overflow: hidden; transition: 0.3s; text-decoration: none; color: inherit; box-shadow: 0 10px 15px rgba(0,0,0,0.5); border: 1px solid #333; }
-    .card:hover { transform: translateY(-5px); border-color: var(--accent); }
-    .poster { width: 100%; aspect-ratio: 2/3; object-fit: cover; }
-    .title { padding: 10px; font-size: 0.85em; text-align: center; white-space: nowrap; overflow: hidden; text-overflow: ellipsis; }
-
-    .back-btn { display: inline-block; margin: 10px 15px; color: var(--accent); text-decoration: none; font-weight: bold; font-size: 0.9em; z-index: 1000; position: relative; }
-    .episode-list { list-style: none; padding: 15px; margin: 0; }
-    .episode-list li { margin: 8px 0; background: var(--card-bg); border-radius: 8px; border: 1px solid transparent; }
-    .episode-list a { display: block; padding: 18px; color: var(--text); text-decoration: none; font-size: 0.95em; }
-    .episode-list li.last-played { border-color: var(--accent); background: #252525; }
-</style>
-"""
+class Coalescer:
+    # Duplicate in-flight requests for the same key wait for the first one's result
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.inflight = {}
+        self.coalesced = 0
+
+    def run(self, key, fn):
+        with self.lock:
+            pending = self.inflight.get(key)
+            if pending is None:
+                pending = self.inflight[key] = {'event': threading.Event(), 'result': None}
+                owner = True
+            else:
+                self.coalesced += 1
+                owner = False
+        if not owner:
+            pending['event'].wait()
+            return pending['result']
+        try:
+            pending['result'] = fn()
+            return pending['result']
+        finally:
+            with self.lock: del self.inflight[key]
+            pending['event'].set()
+
+media_lock = threading.Lock()
+media_executors = {}  # 'interactive' (PREVIEW_WORKERS processes) / 'background' (one process)
+
+def run_media(fn, *args, background=False):
+    # Calls a media.py function in-process, or in the preview worker processes. Whole-episode
+    # work (sprites, background probes) has its own process, so hovers, posters and /metrics
+    # never queue behind it; interactive calls raise MediaTimeout after MEDIA_TIMEOUT.
+    if PREVIEW_WORKERS <= 0: return fn(*args)
+    kind = 'background' if background else 'interactive'
+    with media_lock:
+        executor = media_executors.get(kind)
+        if executor is None:
+            # spawn, not fork: request threads may hold locks at fork time
+            executor = media_executors[kind] = ProcessPoolExecutor(
+                1 if background else PREVIEW_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+    future = executor.submit(fn, *args)
+    try:
+        return future.result(timeout=None if background else MEDIA_TIMEOUT)
+    except MediaTimeout:
+        future.cancel()  # still queued: don't decode for a caller that is gone
+        raise
+    except BrokenProcessPool:
+        # A worker died (e.g. OOM on a huge frame): start a fresh pool next time
+        with media_lock:
+            if media_executors.get(kind) is executor: del media_executors[kind]
+        raise
+
+IONICE = shutil.which('ionice')
+
+def background_cmd(cmd):
+    # os.nice() (TRANSCODE_NICE) only lowers CPU priority; whole-file reads also go in the
+    # idle I/O class so they only use the disk when streams don't need it
+    return [IONICE, '-c3', *cmd] if IONICE else cmd
+
+def atomic_write(path, data):
+    # Readers (and other gunicorn workers) only ever see a complete file
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        with open(tmp, 'wb') as f: f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp): os.remove(tmp)
+        raise
+
+def atomic_write_json(path, obj):
+    atomic_write(path, json.dumps(obj).encode())
+
+class BackgroundQueue:
+    # Jobs for one lazily started daemon thread (restarted if it ever died). A key that is
+    # already queued or running isn't queued again; handler(*args) does the work.
+    def __init__(self, name, handler):
+        self.name = name
+        self.handler = handler
+        self.lock = threading.Lock()
+        self.pending = set()
+        self.queue = queue.Queue()
+        self.worker = None
+
+    def put(self, key, *args):
+        with self.lock:
+            if key in self.pending: return False
+            self.pending.add(key)
+            if self.worker is None or not self.worker.is_alive():
+                self.worker = threading.Thread(target=self.worker_loop, name=self.name, daemon=True)
+                self.worker.start()
+        self.queue.put((key, args))
+        return True
+
+    def worker_loop(self):
+        while True:
+            key, args = self.queue.get()
+            try:
+                self.handler(*args)
+            except Exception:
+                log.exception("%s failed for %s", self.name, args[0] if args else key)
+            finally:
+                with self.lock: self.pending.discard(key)
+
+    def __len__(self):
+        with self.lock: return len(self.pending)
+
+preview_requests = Coalescer()
+preview_slots = threading.BoundedSemaphore(PREVIEW_MAX_CONCURRENCY)
+
+# Season/episode numbers in filenames, most explicit patterns first
+SEASON_EPISODE_RES = [
+    re.compile(r'(?i)\bs(\d{1,2})[ ._-]*e(\d{1,4})'),                          # S01E02
+    re.compile(r'(?i)\b(\d{1,2})x(\d{1,4})\b'),                                # 1x02
+    re.compile(r'(?i)season[ ._-]*(\d{1,2}).*?\b(?:ep|episode|e)[ ._-]*(\d{1,4})'),
+]
+EPISODE_RES = [
+    re.compile(r'(?i)\b(?:ep|episode|e)[ ._-]*(\d{1,4})(?!\d)'),               # Ep 02, Episode02
+    re.compile(r'\s-\s*(\d{1,4})(?:v\d)?\b'),                                  # Show - 02 [1080p]
+    re.compile(r'(?:^|[ ._\[(-])(\d{1,4})(?:v\d)?(?=[ ._\])-]|$)'),            # last bare number
+]
+SPECIAL_RE = re.compile(r'(?i)\b(?:ova|oad|sp|special|specials|nc ?op|nc ?ed|movie)\b')
+
+def parse_episode_number(name):
+    # (season, episode); either may be None
+    stem = os.path.splitext(name)[0]
+    for pattern in SEASON_EPISODE_RES:
+        match = pattern.search(stem)
+        if match: return int(match.group(1)), int(match.group(2))
+    season = re.search(r'(?i)\b(?:season|s)[ ._]*(\d{1,2})\b|\b(\d{1,2})(?:st|nd|rd|th)[ ._]+season\b', stem)
+    season = int(season.group(1) or season.group(2)) if season else None
+    for pattern in EPISODE_RES:
+        matches = pattern.findall(stem)
+        if matches: return season, int(matches[-1])
+    return season, None
+
+def natural_key(name):
+    # "Ep 2" < "Ep 10"
+    return [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', name.lower())]
+
+def episode_sort_key(name):
+    # Numbered episodes by (season, episode), then specials and anything unnumbered
+    season, episode = parse_episode_number(name)
+    special = episode is None or SPECIAL_RE.search(os.path.splitext(name)[0]) is not None
+    return (special, season or 1, episode or 0, natural_key(name))
+
+class LibraryIndex:
+    # Shows, episodes, posters, resolution folders and subtitles, built once and
+    # kept fresh by polling directory mtimes. Persisted to a snapshot so restarts
+    # only have to stat directories instead of listing the whole library.
+    FORMAT = 2  # bump when the shape of a show entry changes (2: natural episode order)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.shows = {}
+        self.root_mtime = None
+        self.version = 0
+        self.started = False
+
+    def snapshot_path(self):
+        return os.path.join(CACHE_DIR, 'library.json')
+
+    def ensure_started(self):
+        if self.started: return
+        with self.lock:
+            if self.started: return
+            self.load_snapshot()
+            self.refresh()
+            threading.Thread(target=self.poll_loop, name='library-poll', daemon=True).start()
+            self.started = True
+
+    def load_snapshot(self):
+        try:
+            with open(self.snapshot_path()) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if data.get('base_dir') != BASE_DIR or data.get('format') != LibraryIndex.FORMAT: return
+        self.shows = data['shows']
+        self.root_mtime = data['root_mtime']
+
+    def save_snapshot(self):
+        try:
+            atomic_write_json(self.snapshot_path(), {'base_dir': BASE_DIR, 'format': LibraryIndex.FORMAT,
+                                                     'root_mtime': self.root_mtime, 'shows': self.shows})
+        except OSError as e:
+            log.warning("could not save library snapshot: %s", e)
+
+    def poll_loop(self):
+        while True:
+            time.sleep(INDEX_POLL_INTERVAL)
+            try:
+                with self.lock: self.refresh()
+            except Exception:
+                log.exception("library refresh failed")
+
+    def refresh(self):
+        try:
+            root_mtime = os.stat(BASE_DIR).st_mtime_ns
+        except OSError:
+            return
+        shows, changed = dict(self.shows), False
+        if root_mtime != self.root_mtime:
+            names = {e.name for e in os.scandir(BASE_DIR) if e.is_dir()}
+            for name in list(shows):
+                if name not in names:
+                    del shows[name]
+                    changed = True
+            for name in names - shows.keys():
+                shows[name] = None
+                changed = True
+        for name, show in shows.items():
+            updated = self.scan_show(name, show)
+            if updated is not show:
+                shows[name] = updated
+                changed = True
+        self.root_mtime = root_mtime
+        if changed:
+            self.shows = shows
+            self.version += 1
+            self.save_snapshot()
+
+    def scan_show(self, name, show):
+        folder_path = os.path.join(BASE_DIR, name)
+        try:
+            mtime = os.stat(folder_path).st_mtime_ns
+        except OSError:
+            return show
+        if show is not None and show['mtime'] == mtime:
+            res = {r: self.scan_res(folder_path, r, info) for r, info in show['res'].items()}
+            # Posters are often replaced in place, which doesn't touch the folder mtime
+            poster_version = self.poster_version(folder_path, show['poster'])
+            if all(res[r] is show['res'][r] for r in res) and poster_version == show.get('poster_version'): return show
+            return dict(show, res=res, poster_version=poster_version)
+        files, dirs = [], set()
+        for entry in os.scandir(folder_path):
+            if entry.is_dir(): dirs.add(entry.name)
+            else: files.append(entry.name)
+        poster = next((f'poster{ext}' for ext in POSTER_EXTS if f'poster{ext}' in files), None)
+        episodes = sorted((f for f in files if f.lower().endswith(VIDEO_EXTS)), key=episode_sort_key)
+        return {
+            'mtime': mtime,
+            'poster': poster,
+            'poster_version': self.poster_version(folder_path, poster),
+            'episodes': episodes,
+            'order': {ep: i for i, ep in enumerate(episodes)},  # O(1) prev/next lookups
+            'subs': sorted(f for f in files if f.lower().endswith('.srt')),
+            'res': {r: self.scan_res(folder_path, r, None) for r in POSSIBLE_RES if r in dirs},
+        }
 
-def get_poster(folder_name):
-    folder_path = os.path.join(BASE_DIR, folder_name)
-    img_exts = ('.jpg', '.jpeg', '.png', '.webp')
-    for ext in img_exts:
-        if os.path.exists(os.path.join(folder_path, f'poster{ext}')):
-            return f'{BASE_PATH}/poster_file/{quote(folder_name)}/poster{ext}'
+    def poster_version(self, folder_path, poster):
+        if poster is None: return None
+        try:
+            return cache_key(os.path.join(folder_path, poster))[:12]
+        except OSError:
+            return None
+
+    def scan_res(self, folder_path, res, info):
+        res_path = os.path.join(folder_path, res)
+        try:
+            mtime = os.stat(res_path).st_mtime_ns
+        except OSError:
+            return info
+        if info is not None and info['mtime'] == mtime: return info
+        files = sorted(f for f in os.listdir(res_path) if f.lower().endswith(VIDEO_EXTS))
+        return {'mtime': mtime, 'files': files}
+
+    def show_names(self):
+        self.ensure_started()
+        return sorted(self.shows)
+
+    def get(self, name):
+        self.ensure_started()
+        return self.shows.get(name)
+
+library = LibraryIndex()
+
+def get_poster(folder_name, width=None, fmt='jpg'):
+    show = library.get(folder_name)
+    if show and show['poster']:
+        url = f'{BASE_PATH}/poster_file/{quote(folder_name)}/{show["poster"]}'
+        # Width-bucketed thumbnail; v= changes whenever the poster does, so it can be cached forever
+        if width: url += f'?w={width}&fmt={fmt}&v={show.get("poster_version")}'
+        return url
+    metrics.inc('anisub_poster_placeholder_total')
     return "https://via.placeholder.com/300x450?text=No+Poster"
 
+def get_poster_srcset(folder_name, fmt):
+    show = library.get(folder_name)
+    if not show or not show['poster']: return ''
+    return ', '.join(f'{get_poster(folder_name, w, fmt)} {w}w' for w in POSTER_WIDTHS)
+
+def cache_key(path):
+    # Invalidates automatically when the file is replaced or modified
+    st = os.stat(path)
+    return hashlib.sha1(f"{path}:{st.st_size}:{st.st_mtime_ns}".encode()).hexdigest()[:20]
+
+def fmt_vtt_time(sec):
+    h, rem = divmod(sec, 3600)
+    m, s = divmod(rem, 60)
+    return f"{int(h):02d}:{int(m):02d}:{s:06.3f}"
+
+# --- EPISODE METADATA ---
+def probe_metadata(path):
+    # Duration, resolution and codecs; ffprobe when available, OpenCV otherwise
+    if shutil.which(FFPROBE):
+        out = subprocess.run([FFPROBE, '-v', 'error', '-show_entries',
+                              'format=duration:stream=codec_type,codec_name,width,height', '-of', 'json', path],
+                             capture_output=True, text=True, timeout=60, check=True).stdout
+        data = json.loads(out)
+        streams = data.get('streams', [])
+        video = next((st for st in streams if st.get('codec_type') == 'video'), {})
+        audio = next((st for st in streams if st.get('codec_type') == 'audio'), {})
+        return {
+            'duration': float(data.get('format', {}).get('duration') or 0),
+            'width': video.get('width'), 'height': video.get('height'),
+            'video_codec': video.get('codec_name'), 'audio_codec': audio.get('codec_name'),
+        }
+    return dict(run_media(media.probe_video, path, background=True), audio_codec=None)
+
+class EpisodeMetadata:
+    # Season/episode numbers from the filename plus probed duration/resolution/codecs, kept
+    # per show in CACHE_DIR/metadata/<show>.json. A show is revalidated by a background
+    # thread when its folder mtime changes; only episodes whose size/mtime changed are reprobed.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.shows = {}  # show -> {'mtime', 'episodes': {name: info}}
+        self.jobs = BackgroundQueue('episode-metadata', self.refresh)
+        self.version = 0
+        self.counters = {'probed': 0, 'reused': 0, 'failed': 0}
+
+    def path(self, folder_name):
+        return os.path.join(CACHE_DIR, 'metadata', hashlib.sha1(folder_name.encode()).hexdigest()[:20] + '.json')
+
+    def get(self, folder_name):
+        # Whatever is known now; a missing or stale show is refreshed in the background
+        show = library.get(folder_name)
+        if show is None: return {}
+        with self.lock: cached = self.shows.get(folder_name)
+        if cached is None:
+            try:
+                with open(self.path(folder_name)) as f: cached = json.load(f)
+            except (OSError, ValueError):
+                cached = {'mtime': None, 'episodes': {}}
+            with self.lock: self.shows[folder_name] = cached
+        if cached['mtime'] != show['mtime']: self.jobs.put(folder_name, folder_name)
+        return cached['episodes']
+
+    def refresh(self, folder_name):
+        show = library.get(folder_name)
+        if show is None: return
+        with self.lock: old = self.shows.get(folder_name, {}).get('episodes', {})
+        episodes = {}
+        for ep in show['episodes']:
+            path = os.path.join(BASE_DIR, folder_name, ep)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            info = old.get(ep)
+            if info and info['size'] == st.st_size and info['mtime_ns'] == st.st_mtime_ns:
+                episodes[ep] = info
+                with self.lock: self.counters['reused'] += 1
+                continue
+            season, number = parse_episode_number(ep)
+            info = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'season': season, 'episode': number}
+            try:
+                info.update(probe_metadata(path))
+                with self.lock: self.counters['probed'] += 1
+            except Exception:
+                log.exception("metadata probe failed for %s", path)
+                with self.lock: self.counters['failed'] += 1
+            episodes[ep] = info
+        cached = {'mtime': show['mtime'], 'episodes': episodes}
+        atomic_write_json(self.path(folder_name), cached)
+        with self.lock:
+            self.shows[folder_name] = cached
+            self.version += 1
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, shows=len(self.shows), pending=len(self.jobs))
+
+episode_metadata = EpisodeMetadata()
+
+def fmt_duration(sec):
+    if not sec: return ''
+    h, rem = divmod(int(sec), 3600)
+    m, s = divmod(rem, 60)
+    return f"{h}:{m:02d}:{s:02d}" if h else f"{m}:{s:02d}"
+
+# --- SEEK PREVIEW SPRITES ---
+def sprite_dir(key):
+    return os.path.join(CACHE_DIR, 'sprites', key)
+
+def queue_sprites(video_path):
+    key = cache_key(video_path)
+    if os.path.exists(os.path.join(sprite_dir(key), 'thumbs.vtt')): return key
+    sprite_jobs.put(key, video_path, key)
+    return key
+
+def generate_sprites(video_path, key):
+    out_dir = sprite_dir(key)
+    tmp_dir = f'{out_dir}.{os.getpid()}.tmp'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    tiles = run_media(media.render_sprites, video_path, tmp_dir, THUMB_INTERVAL, THUMB_WIDTH, SPRITE_COLS, SPRITE_ROWS,
+                      background=True)
+    if not tiles:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        return
+    cues = [f"{fmt_vtt_time(start)} --> {fmt_vtt_time(end)}\n"
+            f"{BASE_PATH}/sprite/{key}/sprite_{sheet_no:03d}.jpg#xywh={x},{y},{w},{h}"
+            for start, end, sheet_no, x, y, w, h in tiles]
+    with open(os.path.join(tmp_dir, 'thumbs.vtt'), 'w') as f:
+        f.write("WEBVTT\n\n" + "\n\n".join(cues) + "\n")
+    shutil.rmtree(out_dir, ignore_errors=True)
+    os.replace(tmp_dir, out_dir)
+
+sprite_jobs = BackgroundQueue('sprite-worker', generate_sprites)
+
+@anisub_bp.route('/thumbs/<path:folder_name>/<path:video_name>')
+def serve_thumbs(folder_name, video_name):
+    video_path = os.path.join(BASE_DIR, unquote(folder_name), unquote(video_name))
+    if not os.path.exists(video_path): abort(404)
+    vtt_path = os.path.join(sprite_dir(queue_sprites(video_path)), 'thumbs.vtt')
+    # Not generated yet: the player keeps using /preview until it is
+    if not os.path.exists(vtt_path): return Response("", status=404)
+    return send_file(vtt_path, mimetype='text/vtt', max_age=3600)
+
+@anisub_bp.route('/sprite/<key>/<name>')
+def serve_sprite(key, name):
+    if not all(ch in '0123456789abcdef' for ch in key): abort(404)
+    # Keyed by file size + mtime, so the content at this URL never changes
+    return send_from_directory(sprite_dir(key), name, max_age=31536000)
+
+def render_preview(video_path, t):
+    if not preview_slots.acquire(timeout=2): return 'busy'
+    try:
+        data, timings = run_media(media.render_preview, video_path, t)
+    except MediaTimeout:
+        return 'busy'
+    finally:
+        preview_slots.release()
+    for stage, seconds in timings.items():
+        metrics.observe('anisub_preview_stage_seconds', seconds, stage=stage)
+    return data
+
+class KeyframeIndex:
+    # Keyframe timestamps per episode, read from ffprobe's packet list (no decoding) by a
+    # background thread the first time an episode is opened and persisted as JSON under
+    # CACHE_DIR/keyframes, plus an LRU of rendered keyframe JPEGs bounded by max_bytes.
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.times = {}  # cache_key -> sorted keyframe timestamps ([] if unavailable)
+        self.jobs = BackgroundQueue('keyframe-index', self.index)
+        self.frames = OrderedDict()  # (cache_key, t) -> jpeg bytes, LRU first
+        self.total = 0
+        self.counters = {'hits': 0, 'misses': 0, 'evictions': 0, 'indexed': 0, 'unindexed': 0}
+
+    def path(self, key):
+        return os.path.join(CACHE_DIR, 'keyframes', f'{key}.json')
+
+    def get(self, video_path, key):
+        with self.lock:
+            times = self.times.get(key)
+        if times is not None: return times
+        try:
+            with open(self.path(key)) as f: times = json.load(f)
+        except (OSError, ValueError):
+            self.enqueue(video_path, key)
+            return None
+        with self.lock: self.times[key] = times
+        return times
+
+    def enqueue(self, video_path, key=None):
+        key = key or cache_key(video_path)
+        with self.lock:
+            if key in self.times: return
+        self.jobs.put(key, video_path, key)
+
+    def index(self, video_path, key):
+        try:
+            times = self.build(video_path, key)
+        except Exception:
+            log.exception("keyframe index failed for %s", video_path)
+            times = []
+        with self.lock: self.times[key] = times
+
+    def build(self, video_path, key):
+        if os.path.exists(self.path(key)):
+            with open(self.path(key)) as f: return json.load(f)
+        if shutil.which(FFPROBE) is None: return []
+        # No decoding, but ffprobe demuxes every packet, i.e. reads the whole file
+        out = subprocess.run(background_cmd([FFPROBE, '-v', 'error', '-select_streams', 'v:0',
+                                             '-show_entries', 'packet=pts_time,flags', '-of', 'csv=p=0', video_path]),
+                             capture_output=True, text=True, timeout=600,
+                             preexec_fn=lambda: os.nice(TRANSCODE_NICE), check=True).stdout
+        times = set()
+        for line in out.splitlines():
+            pts, _, flags = line.partition(',')
+            if 'K' in flags and pts not in ('', 'N/A'): times.add(round(float(pts), 3))
+        times = sorted(times)
+        atomic_write_json(self.path(key), times)
+        return times
+
+    def snap(self, video_path, t):
+        # Nearest keyframe to t, or t itself while the index is missing
+        key = cache_key(video_path)
+        times = self.get(video_path, key)
+        with self.lock: self.counters['indexed' if times else 'unindexed'] += 1
+        if not times: return key, t
+        i = bisect.bisect_left(times, t)
+        near = [times[j] for j in (i - 1, i) if 0 <= j < len(times)]
+        return key, min(near, key=lambda k: abs(k - t))
+
+    def frame(self, key):
+        with self.lock:
+            data = self.frames.get(key)
+            if data is None:
+                self.counters['misses'] += 1
+                return None
+            self.frames.move_to_end(key)
+            self.counters['hits'] += 1
+            return data
+
+    def store(self, key, data):
+        with self.lock:
+            old = self.frames.pop(key, None)
+            if old is not None: self.total -= len(old)
+            self.frames[key] = data
+            self.total += len(data)
+            while self.total > self.max_bytes and len(self.frames) > 1:
+                self.total -= len(self.frames.popitem(last=False)[1])
+                self.counters['evictions'] += 1
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, episodes=len(self.times), pending=len(self.jobs),
+                        frames=len(self.frames), bytes=self.total)
+
+keyframes = KeyframeIndex(KEYFRAME_CACHE_BYTES)
+
 @anisub_bp.route('/preview/<path:folder_name>/<path:video_name>')
 def get_preview(folder_name, video_name):
+    video_path = os.path.join(BASE_DIR, unquote(folder_name), unquote(video_name))
+    if not os.path.exists(video_path): abort(404)
     try:
-        t = float(request.args.get('t', 0))
-        video_path = os.path.join(BASE_DIR, unquote(folder_name), unquote(video_name))
-        if video_path not in preview_caps:
-            if len(preview_caps) > 5:
-                old_path = next(iter(preview_caps))
-                preview_caps[old_path].release()
-                del preview_caps[old_path]
-            preview_caps[video_path] = cv2.VideoCapture(video_path)
-        cap = preview_caps[video_path]
-        cap.set(cv2.CAP_PROP_POS_MSEC, t * 1000)
-        success, frame = cap.read()
-        if not success: return abort(404)
-        height, width = frame.shape[:2]
-        new_width = 180
-        new_height = int(height * (new_width / width))
-        resized = cv2.resize(frame, (new_width, new_height), interpolation=cv2.INTER_AREA)
-        _, buffer = cv2.imencode('.jpg', resized, [cv2.IMWRITE_JPEG_QUALITY, 50])
-        return Response(buffer.tobytes(), mimetype='image/jpeg')
+        t = round(float(request.args.get('t', 0)), 1)
+        key, t = keyframes.snap(video_path, t)
+        data = keyframes.frame((key, t))
+        if data is None:
+            data = preview_requests.run((key, t), lambda: render_preview(video_path, t))
+            if data and data != 'busy': keyframes.store((key, t), data)
     except Exception: abort(500)
+    if data is None: abort(404)
+    if data == 'busy': return Response("", status=503, headers={'Retry-After': '1'})
+    # Timestamp of the frame actually returned (the keyframe the request snapped to)
+    return Response(data, mimetype='image/jpeg', headers={'X-Preview-Time': f'{t:.3f}'})
+
+@anisub_bp.route('/preview_stats')
+def preview_stats():
+    return jsonify(preview_stats_values())
+
+def preview_stats_values():
+    # With preview workers the pool numbers are those of whichever worker answered
+    # (nothing until the workers have been started by a first preview)
+    try:
+        stats = {} if PREVIEW_WORKERS > 0 and 'interactive' not in media_executors else run_media(media.pool_stats)
+    except MediaTimeout:
+        stats = {}
+    stats.update(coalesced=preview_requests.coalesced, workers=PREVIEW_WORKERS)
+    stats.update({f'keyframe_{k}': v for k, v in keyframes.stats().items()})
+    return stats
+
+# --- TEMPLATES & ASSETS ---
+ASSET_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+asset_hashes = {}
+fragment_cache = {}
+
+def asset_url(name):
+    # Content-hashed, so the asset can be cached forever and still update on deploy
+    digest = asset_hashes.get(name)
+    if digest is None:
+        with open(os.path.join(ASSET_DIR, name), 'rb') as f:
+            digest = asset_hashes[name] = hashlib.sha1(f.read()).hexdigest()[:12]
+    return f'{BASE_PATH}/assets/{name}?v={digest}'
+
+def render_fragment(template, key, stamp=None, **context):
+    # Library-derived HTML only changes when the index (or the caller's stamp) does
+    cached = fragment_cache.get((template, key))
+    version = (library.version, stamp)
+    if cached and cached[0] == version: return cached[1]
+    html = Markup(render_template(template, **context))
+    fragment_cache[(template, key)] = (version, html)
+    return html
+
+@anisub_bp.context_processor
+def template_globals():
+    return dict(base_path=BASE_PATH, asset_url=asset_url, get_poster=get_poster, get_poster_srcset=get_poster_srcset,
+                poster_widths=POSTER_WIDTHS, poster_sizes=POSTER_SIZES, fmt_duration=fmt_duration)
+
+@anisub_bp.route('/assets/<name>')
+def serve_asset(name):
+    immutable = name in asset_hashes and request.args.get('v') == asset_hashes[name]
+    response = send_from_directory(ASSET_DIR, name, max_age=31536000 if immutable else 300)
+    if immutable: response.cache_control.immutable = True
+    return response
 
 @anisub_bp.route('/')
 def index():
-    folders = sorted([d for d in os.listdir(BASE_DIR) if os.path.isdir(os.path.join(BASE_DIR, d))])
-    return render_template_string(f"""
-    <!DOCTYPE html><html><head><title>Anime Library</title><meta name="viewport" content="width=device-width, initial-scale=1.0">{KODI_STYLE}</head>
-    <body>
-        <h1>Anime Library</h1>
-        <div class="grid">
-            {{% for folder in folders %}}
-            <a href="{BASE_PATH}/show/{{{{ folder | urlencode }}}}" class="card">
-                <img class="poster" src="{{{{ get_poster(folder) }}}}" alt="Poster">
-                <div class="title">{{{{ folder }}}}</div>
-            </a>
-            {{% endfor %}}
-        </div>
-    </body></html>
-    """, folders=folders, get_poster=get_poster)
+    recent = [r for r in progress_store.recent_shows(current_profile(), CONTINUE_WATCHING_LIMIT)
+              if library.get(r['show']) and r['episode'] in library.get(r['show'])['episodes']]
+    # Only the first page is rendered; library.js fetches the rest from /api/shows
+    page, next_cursor = paginate(search_index.search('', 'show'), None, PAGE_SIZE)
+    show_grid = render_fragment('_show_grid.html', None, folders=[show for _, show, _ in page])
+    return render_template('index.html', recent=recent, show_grid=show_grid, next_cursor=next_cursor)
 
 @anisub_bp.route('/show/<path:folder_name>')
 def list_episodes(folder_name):
     folder_name = unquote(folder_name)
-    folder_path = os.path.join(BASE_DIR, folder_name)
-    if not os.path.exists(folder_path): abort(404)
-    video_exts = ('.mkv', '.mp4', '.webm')
-    episodes = sorted([f for f in os.listdir(folder_path) if f.lower().endswith(video_exts)])
-    return render_template_string(f"""
-    <!DOCTYPE html><html><head><title>{{{{ folder_name }}}}</title><meta name="viewport" content="width=device-width, initial-scale=1.0">{KODI_STYLE}</head>
-    <body>
-        <a href="{BASE_PATH}/" class="back-btn">← BACK TO LIBRARY</a>
-        <h2>{{{{ folder_name }}}}</h2>
-        <ul class="episode-list" id="epList">
-            {{% for ep in episodes %}}
-            <li data-epname="{{{{ ep }}}}">
-                <a href="{BASE_PATH}/play/{{{{ folder_name | urlencode }}}}/{{{{ ep | urlencode }}}}">{{{{ ep }}}}</a>
-            </li>
-            {{% endfor %}}
-        </ul>
-        <script>
-            const history = JSON.parse(localStorage.getItem('anisub_history') || '{{}}');
-            const lastEp = history["{{{{ folder_name }}}}"]?.last_ep;
-            if (lastEp) {{
-                document.querySelectorAll('#epList li').forEach(li => {{
-                    if (li.getAttribute('data-epname') === lastEp) li.classList.add('last-played');
-                }});
-            }}
-        </script>
-    </body></html>
-    """, folder_name=folder_name, episodes=episodes)
+    show = library.get(folder_name)
+    if show is None: abort(404)
+    profile = current_profile()
+    progress = progress_store.show_progress(profile, folder_name)
+    last_ep, _ = progress_store.last_episode(profile, folder_name)
+    metadata = episode_metadata.get(folder_name)
+    episode_list = render_fragment('_episode_list.html', folder_name, stamp=episode_metadata.version,
+                                   folder_name=folder_name, episodes=show['episodes'], metadata=metadata)
+    return render_template('show.html', folder_name=folder_name, episode_list=episode_list, progress=progress, last_ep=last_ep)
 
 @anisub_bp.route('/play/<path:folder_name>/<path:video_name>')
 def player(folder_name, video_name):
     folder_name, video_name = unquote(folder_name), unquote(video_name)
     folder_path = os.path.join(BASE_DIR, folder_name)
+    show = library.get(folder_name)
+    if show is None: abort(404)
 
-    possible_res = ['240p', '360p', '480p', '720p', '1080p']
-    available_res = [r for r in possible_res if os.path.isdir(os.path.join(folder_path, r))]
+    available_res = list(show['res'])
+    all_eps = show['episodes']
 
-    video_exts = ('.mkv', '.mp4', '.webm')
-    all_eps = sorted([f for f in os.listdir(folder_path) if f.lower().endswith(video_exts)])
-
-    try:
-        curr_idx = all_eps.index(video_name)
-    except ValueError:
-        abort(404)
+    curr_idx = show['order'].get(video_name)
+    if curr_idx is None: abort(404)
 
     prev_ep = all_eps[curr_idx - 1] if curr_idx > 0 else None
     next_ep = all_eps[curr_idx + 1] if curr_idx < len(all_eps) - 1 else None
-    srt_name = os.path.splitext(video_name)[0] + ".srt"
-
-    player_styles = """
-    <style>
-        #mainPlayerContainer { background: #000; display: flex; flex-direction: column; width: 100%; height: 100vh; height: 100svh; position: fixed; top: 0; left: 0; overflow: hidden; }
-        .player-wrapper { position: relative; width: 100%; flex-grow: 1; background: #000; overflow: hidden; display: flex; align-items: center; justify-content: center; cursor: none; }
-        .player-wrapper.ui-on { cursor: default; }
-        video { width: 100%; max-height: 100%; object-fit: contain; }
-
-        .ui-element { transition: opacity 0.25s ease-in-out; opacity: 1; visibility: visible; }
-        .ui-hidden { opacity: 0 !important; pointer-events: none !important; visibility: hidden !important; }
-
-        .custom-controls { position: absolute; bottom: 0; left: 0; width: 100%; background: linear-gradient(transparent, rgba(0, 0, 0, 0.9) 30%); padding: 5px 12px calc(15px + env(safe-area-inset-bottom)) 12px; z-index: 100; box-sizing: border-box; }
-        .controls-row { display: flex; align-items: center; justify-content: space-between; margin-top: 2px; }
-        .control-group { display: flex; align-items: center; gap: 4px; }
-        .control-btn { background: none; border: none; color: white; cursor: pointer; padding: 8px; display: flex; align-items: center; }
-        .control-btn:disabled { opacity: 0.3; cursor: not-allowed; pointer-events: none; }
-        .control-btn svg { width: 24px; height: 24px; fill: currentColor; }
-
-        .seek-container { display: flex; align-items: center; gap: 8px; width: 100%; }
-        .seek-bar { flex-grow: 1; accent-color: var(--accent); height: 20px; cursor: pointer; touch-action: none; margin: 0; }
-        .mobile-time { display: none; font-family: monospace; font-size: 0.75em; color: #bbb; white-space: nowrap; }
-        #centerFeedback {
-            position: absolute; top: 50%; left: 50%; transform: translate(-50%, -50%);
-            background: rgba(0,0,0,0.6); /* Darkened slightly */
-            backdrop-filter: blur(4px);   /* Added blur for contrast */
-            border-radius: 50%; width: 72px; height: 72px;
-            display: flex; align-items: center; justify-content: center; z-index: 110;
-            pointer-events: none; opacity: 1; transition: opacity 0.3s, transform 0.3s;
-            border: 1px solid rgba(255,255,255,0.2); /* Added subtle rim */
-        }
+    subtitle_list, subtitles_pending = subtitle_tracks(folder_name, video_name)
+    # Cheap next-episode resources the page adds as <link rel=prefetch> at PREFETCH_AT
+    # (the stream itself is warmed server-side, a prefetch would download all of it)
+    prefetch_urls = []
+    if next_ep and PREFETCH_AT > 0:
+        next_path = f'{quote(folder_name)}/{quote(next_ep)}'
+        prefetch_urls.append(f'{BASE_PATH}/play/{next_path}')
+        next_srt = os.path.splitext(next_ep)[0] + ".srt"
+        if next_srt in show['subs']: prefetch_urls.append(f'{BASE_PATH}/sub/{quote(folder_name)}/{quote(next_srt)}')
+    # Start building the sprite sheets in the background on first view
+    queue_sprites(os.path.join(folder_path, video_name))
+    keyframes.enqueue(os.path.join(folder_path, video_name))
+    hls_enabled = ffmpeg_available() and bool(hls_ready_renditions(folder_name, video_name))
+    # Vendored, never loaded from a CDN: a LAN-only server would stall every player page on it
+    hls_js = hls_enabled and os.path.exists(os.path.join(ASSET_DIR, 'hls.min.js'))
+    profile = current_profile()
+    resume_at = progress_store.show_progress(profile, folder_name).get(video_name, {}).get('position', 0)
+    preferred_res = progress_store.preference(profile, 'preferred_res')
+
+    player_config = {
+        'basePath': BASE_PATH,
+        'show': folder_name,
+        'episode': video_name,
+        'mediaPath': f'{quote(folder_name)}/{quote(video_name)}',
+        'hlsEnabled': hls_enabled,
+        'availableRes': available_res,
+        'resumeAt': resume_at,
+        'preferredRes': preferred_res,
+        'prefetchAt': PREFETCH_AT,
+        'prefetchUrls': prefetch_urls,
+        'subtitlesPending': subtitles_pending,
+    }
+    return render_template('player.html', folder_name=folder_name, video_name=video_name,
+                           subtitle_tracks=subtitle_list, prev_ep=prev_ep, next_ep=next_ep, available_res=available_res,
+                           hls_js=hls_js, player_config=player_config)
+
+# --- SEARCH & JSON API ---
+def normalize_name(name):
+    # Lowercase words; leading zeros dropped so "ep 2" finds "Episode 02"
+    text = re.sub(r'[^0-9a-z]+', ' ', os.path.splitext(name)[0].lower())
+    return ' '.join(re.sub(r'\b0+(?=\d)', '', text).split())
+
+def trigrams(text):
+    padded = f'  {text} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+class SearchIndex:
+    # Show and episode names, rebuilt whenever the library index version changes.
+    # Prefix search bisects a sorted (word, entry) list; fuzzy search scores entries by
+    # the fraction of the query's trigrams they contain.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = None
+        self.entries = []  # (show, episode or None, normalized text)
+        self.words = []
+        self.grams = {}
+
+    def ensure_current(self):
+        names = library.show_names()
+        if self.version == library.version: return
+        with self.lock:
+            if self.version == library.version: return
+            version = library.version
+            entries = []
+            for show in names:
+                entries.append((show, None, normalize_name(show)))
+                info = library.get(show)
+                for ep in (info['episodes'] if info else ()):
+                    entries.append((show, ep, f'{normalize_name(show)} {normalize_name(ep)}'))
+            words, grams = [], {}
+            for i, (_, _, text) in enumerate(entries):
+                words.extend((word, i) for word in set(text.split()))
+                for gram in trigrams(text): grams.setdefault(gram, []).append(i)
+            words.sort()
+            self.entries, self.words, self.grams, self.version = entries, words, grams, version
+
+    def search(self, query, kind='all'):
+        # Returns (sort key, show, episode) tuples in result order; an empty query lists everything
+        self.ensure_current()
+        entries, words, grams = self.entries, self.words, self.grams
+        wanted = lambda i: kind == 'all' or (kind == 'show') == (entries[i][1] is None)
+        query = normalize_name(query)
+        if not query:
+            return [((0, show, ep or ''), show, ep) for i, (show, ep, _) in enumerate(entries) if wanted(i)]
+        scores = {}
+        # Every query word must prefix some word of the name
+        matched = None
+        for qword in query.split():
+            ids, i = set(), bisect.bisect_left(words, (qword,))
+            while i < len(words) and words[i][0].startswith(qword):
+                ids.add(words[i][1])
+                i += 1
+            matched = ids if matched is None else matched & ids
+        for i in matched:
+            scores[i] = 3 if entries[i][2].startswith(query) else 2
+        # Typos: at least half of the query's trigrams
+        qgrams = trigrams(query)
+        counts = {}
+        for gram in qgrams:
+            for i in grams.get(gram, ()): counts[i] = counts.get(i, 0) + 1
+        for i, count in counts.items():
+            similarity = count / len(qgrams)
+            if similarity >= 0.5 and similarity > scores.get(i, 0): scores[i] = similarity
+        results = [((-round(score, 3), entries[i][0], entries[i][1] or ''), entries[i][0], entries[i][1])
+                   for i, score in scores.items() if wanted(i)]
+        results.sort()
+        return results
+
+search_index = SearchIndex()
+
+def encode_cursor(key):
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    try:
+        return tuple(json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))))
+    except (ValueError, TypeError):
+        abort(400)
+
+def paginate(results, cursor, limit):
+    # Keyset pagination: the cursor is the sort key of the last item already returned,
+    # so pages stay consistent when shows are added or removed in between
+    start = 0
+    if cursor:
+        try:
+            start = bisect.bisect_right(results, decode_cursor(cursor), key=lambda result: result[0])
+        except TypeError:
+            abort(400)
+    page = results[start:start + limit]
+    next_cursor = encode_cursor(page[-1][0]) if start + limit < len(results) else None
+    return page, next_cursor
+
+def page_limit():
+    return min(max(request.args.get('limit', PAGE_SIZE, type=int), 1), MAX_PAGE_SIZE)
+
+def show_item(show):
+    info = library.get(show) or {}
+    return {
+        'kind': 'show', 'name': show,
+        'url': f'{BASE_PATH}/show/{quote(show)}',
+        'poster': get_poster(show, POSTER_WIDTHS[0]),
+        'srcset': get_poster_srcset(show, 'jpg'),
+        'srcset_webp': get_poster_srcset(show, 'webp'),
+        'episodes': len(info.get('episodes', ())),
+    }
 
-        .seek-ripple {
-            position: absolute; top: 0; width: 40%; height: 100%;
-            background: rgba(255,255,255,0.2); display: flex; flex-direction: column;
-            align-items: center; justify-content: center; opacity: 0; pointer-events: none;
-            z-index: 40; transition: opacity 0.2s;
-        }
-        .seek-ripple.left { left: 0; border-radius: 0 100% 100% 0; }
-        .seek-ripple.right { right: 0; border-radius: 100% 0 0 100%; }
-        .seek-text {
-            color: white;
-            font-weight: bold;
-            font-size: 0.9em;
-            margin-top: 5px;
-            text-shadow: 0px 0px 4px rgba(0,0,0,0.9), 0px 0px 10px rgba(0,0,0,0.5); /* Fix for white backgrounds */
-        }
+def episode_item(show, ep):
+    return {'kind': 'episode', 'show': show, 'name': ep, 'url': f'{BASE_PATH}/play/{quote(show)}/{quote(ep)}'}
+
+@anisub_bp.route('/api/shows')
+def api_shows():
+    page, next_cursor = paginate(search_index.search(request.args.get('q', ''), 'show'),
+                                 request.args.get('cursor'), page_limit())
+    return jsonify(items=[show_item(show) for _, show, _ in page], next_cursor=next_cursor)
+
+@anisub_bp.route('/api/search')
+def api_search():
+    kind = request.args.get('type', 'all')
+    if kind not in ('all', 'show', 'episode'): abort(400)
+    page, next_cursor = paginate(search_index.search(request.args.get('q', ''), kind),
+                                 request.args.get('cursor'), page_limit())
+    items = [show_item(show) if ep is None else episode_item(show, ep) for _, show, ep in page]
+    return jsonify(items=items, next_cursor=next_cursor)
+
+@anisub_bp.route('/api/episodes/<path:folder_name>')
+def api_episodes(folder_name):
+    folder_name = unquote(folder_name)
+    show = library.get(folder_name)
+    if show is None: abort(404)
+    results = [((i,), folder_name, ep) for i, ep in enumerate(show['episodes'])]
+    page, next_cursor = paginate(results, request.args.get('cursor'), page_limit())
+    metadata = episode_metadata.get(folder_name)
+    items = []
+    for _, _, ep in page:
+        info = metadata.get(ep, {})
+        items.append(dict(episode_item(folder_name, ep), season=info.get('season'), episode=info.get('episode'),
+                          duration=info.get('duration'), video_codec=info.get('video_codec')))
+    return jsonify(items=items, next_cursor=next_cursor)
+
+# --- STREAMING ---
+def stream_etag(st):
+    return f"{st.st_size:x}-{st.st_mtime_ns:x}"
+
+def resolve_ranges(size, etag, mtime):
+    # None: serve the whole file, []: unsatisfiable, else a list of (start, stop)
+    rng = request.range
+    if rng is None or rng.units != 'bytes': return None
+    if_range = request.if_range
+    if if_range.etag is not None or if_range.date is not None:
+        # If-Range only matches the current representation exactly (strong comparison)
+        if if_range.etag is not None and if_range.etag != etag: return None
+        if if_range.date is not None and int(if_range.date.timestamp()) != int(mtime): return None
+    ranges = []
+    for start, stop in rng.ranges:
+        if start < 0: start, stop = max(0, size + start), size
+        elif stop is None:
+            stop = min(size, start + STREAM_RANGE_CAP) if STREAM_RANGE_CAP and len(rng.ranges) == 1 else size
+        elif stop > size: stop = size
+        if start < stop: ranges.append((start, stop))
+    if len(ranges) > STREAM_MAX_RANGES: return None
+    return ranges
+
+def advise(fd, offset, length):
+    if not hasattr(os, 'posix_fadvise'): return
+    try:
+        os.posix_fadvise(fd, offset, length, os.POSIX_FADV_SEQUENTIAL)
+        os.posix_fadvise(fd, offset, min(length, STREAM_READAHEAD), os.POSIX_FADV_WILLNEED)
+    except OSError:
+        pass
+
+def iter_range(fd, start, stop, chunk=STREAM_CHUNK):
+    pos = start
+    while pos < stop:
+        data = os.pread(fd, min(chunk, stop - pos), pos)
+        if not data: break
+        pos += len(data)
+        yield data
+
+def iter_multipart(f, ranges, size, mime, boundary):
+    for start, stop in ranges:
+        yield (f"\r\n--{boundary}\r\nContent-Type: {mime}\r\n"
+               f"Content-Range: bytes {start}-{stop - 1}/{size}\r\n\r\n").encode()
+        yield from iter_range(f.fileno(), start, stop, f.chunk)
+    yield f"\r\n--{boundary}--\r\n".encode()
+
+def iter_paced(body, client, res):
+    # Holds each chunk back until the egress and client buckets allow it
+    sent = 0
+    for data in body:
+        stream_scheduler.pace(client, res, len(data), priority=sent < STREAM_PLAYBACK_WINDOW)
+        sent += len(data)
+        yield data
+
+class TokenBucket:
+    # Tokens are bytes; take() may run into debt and returns how long to wait it off
+    def __init__(self, rate):
+        self.rate = rate
+        self.capacity = max(rate * STREAM_BURST_SECONDS, STREAM_THROTTLE_CHUNK)
+        self.tokens = self.capacity
+        self.stamp = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def take(self, n, now):
+        self.refill(now)
+        self.tokens -= n
+        return max(0.0, -self.tokens / self.rate)
+
+class StreamScheduler:
+    # Token buckets for /stream bodies: one for total egress and one per (client, resolution).
+    # Playback-window chunks may borrow from the egress bucket; read-ahead chunks only spend
+    # tokens that are already there, so they always queue behind playback.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.egress = TokenBucket(STREAM_EGRESS_LIMIT) if STREAM_EGRESS_LIMIT > 0 else None
+        self.clients = {}  # (client, res) -> TokenBucket
+        self.open = {}  # client -> open streams
+        self.counters = {'rejected': 0, 'paced_bytes': 0, 'playback_bytes': 0, 'wait_seconds': 0.0}
+
+    def client_rate(self, res):
+        return STREAM_CLIENT_LIMITS.get(res, STREAM_CLIENT_LIMIT)
+
+    def throttles(self, res):
+        return self.egress is not None or self.client_rate(res) > 0
+
+    def acquire(self, client):
+        with self.lock:
+            if STREAM_MAX_PER_CLIENT > 0 and self.open.get(client, 0) >= STREAM_MAX_PER_CLIENT:
+                self.counters['rejected'] += 1
+                return False
+            self.open[client] = self.open.get(client, 0) + 1
+            return True
+
+    def release(self, client):
+        with self.lock:
+            self.open[client] -= 1
+            if not self.open[client]: del self.open[client]
+
+    def pace(self, client, res, n, priority):
+        # Blocks until n more bytes of this client's stream may go out
+        while True:
+            done, delay = self._reserve(client, res, n, priority)
+            time.sleep(delay)
+            if done: return
+
+    def _reserve(self, client, res, n, priority):
+        with self.lock:
+            now = time.monotonic()
+            if self.egress is not None and not priority:
+                self.egress.refill(now)
+                if self.egress.tokens < n:
+                    # Read-ahead only spends tokens that are already there; re-checked after
+                    # the sleep, as playback chunks may have taken them meanwhile
+                    delay = min(0.25, (n - self.egress.tokens) / self.egress.rate)
+                    self.counters['wait_seconds'] += delay
+                    return False, delay
+            delay = self.egress.take(n, now) if self.egress is not None else 0.0
+            rate = self.client_rate(res)
+            if rate > 0:
+                bucket = self.clients.get((client, res))
+                if bucket is None:
+                    self._sweep(now)
+                    bucket = self.clients[(client, res)] = TokenBucket(rate)
+                delay = max(delay, bucket.take(n, now))
+            self.counters['paced_bytes'] += n
+            if priority: self.counters['playback_bytes'] += n
+            self.counters['wait_seconds'] += delay
+            return True, delay
+
+    def _sweep(self, now):
+        # Forget buckets that have been full (idle) for a while
+        for key, bucket in list(self.clients.items()):
+            if now - bucket.stamp > 60 and key[0] not in self.open: del self.clients[key]
+
+    def stats(self):
+        with self.lock:
+            now = time.monotonic()
+            clients = {}
+            for (client, res), bucket in self.clients.items():
+                bucket.refill(now)
+                clients.setdefault(client, {'open': self.open.get(client, 0), 'buckets': {}})['buckets'][res] = {
+                    'rate': bucket.rate, 'tokens': int(bucket.tokens)}
+            for client, count in self.open.items():
+                clients.setdefault(client, {'open': count, 'buckets': {}})
+            egress = None
+            if self.egress is not None:
+                self.egress.refill(now)
+                egress = {'rate': self.egress.rate, 'tokens': int(self.egress.tokens)}
+            return dict(self.counters, wait_seconds=round(self.counters['wait_seconds'], 3), egress=egress,
+                        client_limit=STREAM_CLIENT_LIMIT, client_limits=STREAM_CLIENT_LIMITS,
+                        max_per_client=STREAM_MAX_PER_CLIENT, clients=clients)
+
+stream_scheduler = StreamScheduler()
+
+def client_id():
+    if STREAM_CLIENT_HEADER:
+        value = request.headers.get(STREAM_CLIENT_HEADER)
+        if value: return value.split(',')[0].strip()
+    return request.remote_addr or 'unknown'
+
+class StreamFile:
+    # File handle behind a /stream body. Counts open streams and the bytes actually sent
+    # (and releases the client's stream slot) and works both with the pread iterators and
+    # as the filelike of the server's file_wrapper.
+    def __init__(self, path, client=None, chunk=STREAM_CHUNK, res='original'):
+        self.f = open(path, 'rb')
+        self.client = client
+        self.chunk = chunk
+        self.res = res
+        self.sent = 0
+        self.closed = False
+        metrics.inc('anisub_active_streams', 1)
+
+    def fileno(self): return self.f.fileno()
+    def tell(self): return self.f.tell()
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.sent += len(data)
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        # socket.sendfile() seeks past what it sent when it is done, so forward seeks count
+        # as sent; the start offset is set with os.lseek() so it isn't counted
+        pos = self.f.tell()
+        new = self.f.seek(offset, whence)
+        if new > pos: self.sent += new - pos
+        return new
+
+    def close(self):
+        if self.closed: return
+        self.closed = True
+        self.f.close()
+        metrics.inc('anisub_active_streams', -1)
+        if self.sent: metrics.inc('anisub_stream_bytes_total', self.sent, res=self.res)
+        if self.client is not None: stream_scheduler.release(self.client)
+
+class StreamBody:
+    # WSGI body over a StreamFile. The file is closed from close(), which the server calls
+    # for HEAD and for clients gone before the first chunk too; a generator's finally
+    # never runs if the generator was never started.
+    def __init__(self, f, chunks):
+        self.f = f
+        self.chunks = chunks
+
+    def __iter__(self):
+        for data in self.chunks:
+            yield data
+            # Resumed, so the server has written the chunk
+            self.f.sent += len(data)
+
+    def close(self):
+        try:
+            if hasattr(self.chunks, 'close'): self.chunks.close()
+        finally:
+            self.f.close()
+
+def stream_file(path, res='original'):
+    try:
+        st = os.stat(path)
+    except OSError:
+        abort(404)
+    size = st.st_size
+    mime = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    etag = stream_etag(st)
 
-        #customSubs { position: absolute; bottom: 10%; width: 100%; text-align: center; pointer-events: none; z-index: 10; transition: bottom 0.3s ease; }
-        .sub-inner { color: white; font-size: 2.1em; text-shadow: 2px 2px 4px #000; font-weight: bold; padding: 0 10px; }
-        .time-display { font-family: monospace; font-size: 0.75em; color: #bbb; white-space: nowrap; margin-left: 5px; }
-        .subtitle-display { background: #111; padding: 10px 15px; color: white; min-height: 40px; font-size: 0.85em; border-top: 1px solid #333; z-index: 5; }
-        .player-back { position: absolute; top: 8px; left: 8px; z-index: 150; text-shadow: 0 0 5px #000; font-size: 0.8em; text-decoration: none; color: white; }
-        select.player-select { background:#222; color:white; border:none; border-radius:4px; padding:3px; font-size: 0.8em; cursor: pointer; }
-
-        @media (max-width: 600px) {
-            .time-display { display: none; }
-            .mobile-time { display: block; }
-            .control-btn { padding: 5px; }
-            .control-group { gap: 2px; }
-        }
-    </style>
-    """
-
-    return render_template_string(f"""
-    <!DOCTYPE html><html><head><title>Anisub Player</title><meta name="viewport" content="width=device-width, initial-scale=1.0, maximum-scale=1.0, user-scalable=no, viewport-fit=cover">{KODI_STYLE}{player_styles}</head>
-    <body>
-        <div id="mainPlayerContainer">
-            <a href="{BASE_PATH}/show/{{{{ folder_name | urlencode }}}}" class="back-btn player-back ui-element">← BACK</a>
-
-            <div class="player-wrapper" id="videoArea" onclick="handleGlobalClick(event)" onmousemove="showUI()">
-                <video id="videoPlayer" playsinline preload="metadata">
-                    <source id="videoSource" src="{BASE_PATH}/stream/{{{{ folder_name | urlencode }}}}/{{{{ video_name | urlencode }}}}" type="video/mp4">
-                    <track id="mainSub" kind="subtitles" src="{BASE_PATH}/sub/{{{{ folder_name | urlencode }}}}/{{{{ srt_name | urlencode }}}}" default>
-                </video>
-
-                <div id="centerFeedback" class="ui-element"><svg width="40" height="40" fill="white" viewBox="0 0 24 24" id="feedbackIcon"></svg></div>
-
-                <div id="seekL" class="seek-ripple left"><svg width="40" height="40" fill="white" viewBox="0 0 24 24"><path d="M11 18V6l-8.5 6 8.5 6zm.5-6l8.5 6V6l-8.5 6z"/></svg><div class="seek-text" id="seekTextL">10 seconds</div></div>
-                <div id="seekR" class="seek-ripple right"><svg width="40" height="40" fill="white" viewBox="0 0 24 24"><path d="M4 18l8.5-6L4 6v12zm9-12v12l8.5-6L13 6z"/></svg><div class="seek-text" id="seekTextR">10 seconds</div></div>
-
-                <div id="customSubs"><span class="sub-inner" id="subSpan"></span></div>
-                <div id="previewContainer" style="position: absolute; bottom: 100px; left: 50%; transform: translateX(-50%); width: 140px; border: 1px solid var(--accent); border-radius: 4px; background: #000; display: none; flex-direction: column; z-index: 200; overflow: hidden;">
-                    <img id="previewImg" style="width:100%; height:auto;" src=""><div id="previewTime" style="font-size:0.7em; text-align:center; padding:2px; color:var(--accent);">00:00</div>
-                </div>
-
-                <div class="custom-controls ui-element" id="controlsBar" onclick="event.stopPropagation()">
-                    <div class="seek-container">
-                        <input type="range" class="seek-bar" id="seekBar" value="0" step="0.1" oninput="updatePreview(this.value)" onchange="manualSeek(this.value)" onmousemove="handleHover(event)" onmouseenter="showPreview()" onmouseleave="hidePreview()" onmousedown="showPreview()" onmouseup="hidePreview()" ontouchstart="showPreview()" ontouchend="hidePreview()">
-                        <div class="mobile-time"><span id="currTimeMob">0:00</span> / <span id="totalTimeMob">0:00</span></div>
-                    </div>
-                    <div class="controls-row">
-                        <div class="control-group">
-                            <button class="control-btn" onclick="location.href='{BASE_PATH}/play/{{{{ folder_name | urlencode }}}}/{{{{ prev_ep | urlencode }}}}'" {{{{ 'disabled' if prev_ep is none else '' }}}}>
-                                <svg viewBox="0 0 24 24"><path d="M6 6h2v12H6zm3.5 6l8.5 6V6z"/></svg>
-                            </button>
-                            <button class="control-btn" onclick="togglePlay()" id="playBtn"><svg viewBox="0 0 24 24" id="playIcon"></svg></button>
-                            <button class="control-btn" onclick="location.href='{BASE_PATH}/play/{{{{ folder_name | urlencode }}}}/{{{{ next_ep | urlencode }}}}'" {{{{ 'disabled' if next_ep is none else '' }}}}>
-                                <svg viewBox="0 0 24 24"><path d="M6 18l8.5-6L6 6v12zM16 6v12h2V6h-2z"/></svg>
-                            </button>
-                            <div class="time-display"><span id="currTime">0:00</span> / <span id="totalTime">0:00</span></div>
-                        </div>
-                        <div class="control-group">
-                            <select id="resSelect" class="player-select" onchange="changeResolution(this.value)">
-                                <option value="original">Orig</option>
-                                {{% for res in available_res %}}
-                                <option value="{{{{ res }}}}">{{{{ res }}}}</option>
-                                {{% endfor %}}
-                            </select>
-                            <select id="speedSelect" class="player-select" onchange="video.playbackRate = this.value">
-                                <option value="1" selected>1x</option><option value="1.5">1.5x</option><option value="2">2x</option>
-                            </select>
-                            <button class="control-btn" onclick="toggleCC()"><svg viewBox="0 0 24 24"><path d="M19 4H5c-1.11 0-2 .9-2 2v12c0 1.1.89 2 2 2h14c1.1 0 2-.9 2-2V6c0-1.1-.9-2-2-2zm-8 7H9.5V10h-2v4h2v-1H11v1c0 .55-.45 1-1 1H7c-.55 0-1-.45-1-1v-4c0-.55.45-1 1-1h3c-.55 0 1 .45 1 1v1zm7 0h-1.5V10h-2v4h2v-1H18v1c0 .55-.45 1-1 1h-3c-.55 0-1-.45-1-1v-4c0-.55.45-1 1-1h3c.55 0 1 .45 1 1v1z"/></svg></button>
-                            <button class="control-btn" onclick="toggleFullScreen()"><svg viewBox="0 0 24 24"><path d="M7 14H5v5h5v-2H7v-3zm-2-4h2V7h3V5H5v5zm12 7h-3v2h5v-5h-2v3zM14 5v2h3v3h2V5h-5z"/></svg></button>
-                        </div>
-                    </div>
-                </div>
-            </div>
-            <div class="subtitle-display" id="subLog"><div id="subText">...</div></div>
-        </div>
-        <script>
-            const video = document.getElementById('videoPlayer');
-            const videoArea = document.getElementById('videoArea');
-            const playIcon = document.getElementById('playIcon');
-            const feedbackIcon = document.getElementById('feedbackIcon');
-            const seekBar = document.getElementById('seekBar');
-            const currTimeEl = document.getElementById('currTime'), currTimeMob = document.getElementById('currTimeMob');
-            const totalTimeEl = document.getElementById('totalTime'), totalTimeMob = document.getElementById('totalTimeMob');
-            const subSpan = document.getElementById('subSpan'), subText = document.getElementById('subText');
-            const previewContainer = document.getElementById('previewContainer'), previewImg = document.getElementById('previewImg'), previewTime = document.getElementById('previewTime');
-            const resSelect = document.getElementById('resSelect');
-
-            let uiVisible = true;
-            let uiTimeout = null;
-            let clickTimer = null;
-            let lastTapTime = 0;
-            let currentSeekSum = 0;
-            let seekResetTimer = null;
-
-            function formatTime(sec) {{
-                if (isNaN(sec)) return "0:00";
-                const h = Math.floor(sec / 3600), m = Math.floor((sec % 3600) / 60), s = Math.floor(sec % 60);
-                return h > 0 ? `${{h}}:${{m.toString().padStart(2, '0')}}:${{s.toString().padStart(2, '0')}}` : `${{m}}:${{s.toString().padStart(2, '0')}}`;
-            }}
-
-            function showUI() {{
-                uiVisible = true;
-                videoArea.classList.add('ui-on');
-                document.querySelectorAll('.ui-element').forEach(el => el.classList.remove('ui-hidden'));
-                resetTimer();
-            }}
-
-            function hideUI() {{
-                if (video.paused) return;
-                uiVisible = false;
-                videoArea.classList.remove('ui-on');
-                document.querySelectorAll('.ui-element').forEach(el => el.classList.add('ui-hidden'));
-            }}
-
-            function resetTimer() {{
-                if (uiTimeout) clearTimeout(uiTimeout);
-                if (!video.paused) uiTimeout = setTimeout(hideUI, 3000);
-            }}
-
-            function forceUI(show) {{
-                if (show) showUI(); else hideUI();
-            }}
-
-            function handleGlobalClick(e) {{
-                const now = Date.now();
-                const rect = videoArea.getBoundingClientRect();
-                const x = e.clientX - rect.left;
-                const y = e.clientY - rect.top;
-
-                if (clickTimer) clearTimeout(clickTimer);
-
-                if (now - lastTapTime < 300) {{
-                    lastTapTime = now;
-                    if (x < rect.width * 0.4) triggerYouTubeSeek('L');
-                    else if (x > rect.width * 0.6) triggerYouTubeSeek('R');
-                    return;
-                }}
-
-                lastTapTime = now;
-                clickTimer = setTimeout(() => {{
-                    const isCenter = x > rect.width * 0.35 && x < rect.width * 0.65 &&
-                                   y > rect.height * 0.3 && y < rect.height * 0.7;
-
-                    if (!uiVisible) {{
-                        showUI();
-                    }} else if (isCenter) {{
-                        togglePlay(true);
-                    }} else {{
-                        hideUI();
-                    }}
-                }}, 250);
-            }}
-
-            function updatePlayIcon() {{
-                const path = video.paused ? 'M8 5v14l11-7z' : 'M6 19h4V5H6v14zm8-14v14h4V5h-4z';
-                const html = `<path d="${{path}}"/>`;
-                playIcon.innerHTML = html;
-                feedbackIcon.innerHTML = html;
-            }}
-
-            function togglePlay(autoHide = false) {{
-                if (video.paused) {{
-                    video.play();
-                    if (autoHide) hideUI(); else resetTimer();
-                }} else {{
-                    video.pause();
-                    showUI();
-                }}
-                updatePlayIcon();
-            }}
-
-            function triggerYouTubeSeek(dir) {{
-                if (seekResetTimer) clearTimeout(seekResetTimer);
-                currentSeekSum += 10;
-                const el = document.getElementById(dir === 'L' ? 'seekL' : 'seekR');
-                const txt = document.getElementById(dir === 'L' ? 'seekTextL' : 'seekTextR');
-                video.currentTime += (dir === 'L' ? -10 : 10);
-                txt.innerText = `${{currentSeekSum}} seconds`;
-                el.style.opacity = '1';
-                setTimeout(() => {{ el.style.opacity = '0'; }}, 600);
-                seekResetTimer = setTimeout(() => {{ currentSeekSum = 0; }}, 1000);
-                resetTimer();
-            }}
-
-            function changeResolution(res) {{
-                const currentTime = video.currentTime;
-                const isPaused = video.paused;
-                localStorage.setItem('anisub_preferred_res', res);
-                video.src = `{BASE_PATH}/stream/{{{{ folder_name | urlencode }}}}/{{{{ video_name | urlencode }}}}?res=${{res}}`;
-                video.load();
-                video.onloadedmetadata = () => {{
-                    video.currentTime = currentTime;
-                    if (!isPaused) video.play();
-                }};
-            }}
-
-            function updatePreview(val) {{
-                const targetTime = (val / 100) * video.duration;
-                previewTime.innerText = formatTime(targetTime);
-                previewContainer.style.left = val + "%";
-                loadPreviewFrame(targetTime);
-            }}
-
-            let isPreviewLoading = false, pendingPreviewTime = null;
-            function loadPreviewFrame(time) {{
-                if (isNaN(time) || isPreviewLoading) {{ pendingPreviewTime = time; return; }}
-                isPreviewLoading = true;
-                const url = `{BASE_PATH}/preview/{{{{ folder_name | urlencode }}}}/{{{{ video_name | urlencode }}}}?t=${{time}}`;
-                const img = new Image();
-                img.onload = () => {{
-                    previewImg.src = url; isPreviewLoading = false;
-                    if (pendingPreviewTime) {{ let t = pendingPreviewTime; pendingPreviewTime = null; loadPreviewFrame(t); }}
-                }};
-                img.src = url;
-            }}
-
-            function handleHover(e) {{
-                const rect = seekBar.getBoundingClientRect();
-                const x = (e.touches ? e.touches[0].clientX : e.clientX) - rect.left;
-                updatePreview(Math.min(Math.max(0, x / rect.width), 1) * 100);
-            }}
-
-            function showPreview() {{ previewContainer.style.display = 'flex'; }}
-            function hidePreview() {{ setTimeout(() => {{ previewContainer.style.display = 'none'; }}, 100); }}
-            function manualSeek(val) {{ video.currentTime = (val / 100) * video.duration; resetTimer(); }}
-            function toggleCC() {{ const t = video.textTracks[0]; t.mode = (t.mode === 'disabled') ? 'hidden' : 'disabled'; if(t.mode==='disabled') subSpan.innerText=""; }}
-
-            function toggleFullScreen() {{
-                if (!document.fullscreenElement) {{
-                    if (videoArea.requestFullscreen) videoArea.requestFullscreen();
-                    else if (video.webkitEnterFullscreen) video.webkitEnterFullscreen();
-                }} else document.exitFullscreen();
-            }}
-
-            video.addEventListener('timeupdate', () => {{
-                seekBar.value = (video.currentTime / video.duration) * 100 || 0;
-                const f = formatTime(video.currentTime);
-                currTimeEl.innerText = currTimeMob.innerText = f;
-                if (Math.floor(video.currentTime) % 10 === 0) {{
-                    const h = JSON.parse(localStorage.getItem('anisub_history') || '{{}}');
-                    h["{folder_name}"] = {{ last_ep: "{video_name}", time: video.currentTime }};
-                    localStorage.setItem('anisub_history', JSON.stringify(h));
-                }}
-            }});
-
-            video.addEventListener('loadedmetadata', () => {{
-                const f = formatTime(video.duration);
-                totalTimeEl.innerText = totalTimeMob.innerText = f;
-                const h = JSON.parse(localStorage.getItem('anisub_history') || '{{}}');
-                if (h["{folder_name}"]?.last_ep === "{video_name}") video.currentTime = h["{folder_name}"].time;
-                updatePlayIcon();
-                resetTimer();
-            }});
-
-            window.addEventListener('DOMContentLoaded', () => {{
-                const prefRes = localStorage.getItem('anisub_preferred_res') || '720p';
-                if (Array.from(resSelect.options).some(opt => opt.value === prefRes)) {{
-                    resSelect.value = prefRes;
-                    video.src = `{BASE_PATH}/stream/{{{{ folder_name | urlencode }}}}/{{{{ video_name | urlencode }}}}?res=${{prefRes}}`;
-                }}
-                updatePlayIcon();
-            }});
-
-            const track = video.textTracks[0];
-            track.mode = 'hidden';
-            track.oncuechange = function() {{
-                if (this.activeCues?.length > 0) subSpan.innerText = subText.innerText = this.activeCues[0].text;
-                else subSpan.innerText = "";
-            }};
-
-            document.addEventListener('keydown', (e) => {{
-                if (e.target.tagName === 'INPUT' || e.target.tagName === 'SELECT') return;
-                showUI();
-                switch (e.key) {{
-                    case 'ArrowLeft': e.preventDefault(); triggerYouTubeSeek('L'); break;
-                    case 'ArrowRight': e.preventDefault(); triggerYouTubeSeek('R'); break;
-                    case ' ': e.preventDefault(); togglePlay(); break;
-                    case 'f': e.preventDefault(); toggleFullScreen(); break;
-                 }}
-            }});
-        </script>
-    </body></html>
-    """, folder_name=folder_name, video_name=video_name, srt_name=srt_name, prev_ep=prev_ep, next_ep=next_ep, available_res=available_res)
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        ranges = resolve_ranges(size, etag, st.st_mtime)
+        if ranges == []:
+            response = Response(status=416)
+            response.headers['Content-Range'] = f"bytes */{size}"
+        elif STREAM_OFFLOAD in ('x-accel-redirect', 'x-sendfile'):
+            # The proxy handles Range/If-Range itself and serves the file zero-copy
+            response = Response(mimetype=mime)
+            if STREAM_OFFLOAD == 'x-accel-redirect':
+                rel = os.path.relpath(path, BASE_DIR)
+                response.headers['X-Accel-Redirect'] = quote(f"{STREAM_ACCEL_PREFIX}/{rel}")
+                # nginx applies the per-client rate itself; the egress cap belongs in its config
+                if stream_scheduler.client_rate(res) > 0:
+                    response.headers['X-Accel-Limit-Rate'] = str(stream_scheduler.client_rate(res))
+            else:
+                response.headers['X-Sendfile'] = path
+        elif not stream_scheduler.acquire(client_id()):
+            # Too many open streams for this client; players retry the range shortly
+            return Response("", status=429, headers={'Retry-After': '1'})
+        else:
+            # Throttled bodies go through the pread iterators in small chunks instead of sendfile
+            throttled = stream_scheduler.throttles(res)
+            client = client_id()
+            try:
+                f = StreamFile(path, client, STREAM_THROTTLE_CHUNK if throttled else STREAM_CHUNK, res)
+            except OSError:
+                stream_scheduler.release(client)
+                abort(404)
+            try:
+                if ranges is not None and len(ranges) > 1:
+                    boundary = hashlib.sha1(f"{etag}{time.time()}".encode()).hexdigest()[:24]
+                    advise(f.fileno(), ranges[0][0], ranges[-1][1] - ranges[0][0])
+                    body = iter_multipart(f, ranges, size, mime, boundary)
+                    if throttled: body = iter_paced(body, client, res)
+                    response = Response(StreamBody(f, body), status=206, direct_passthrough=True,
+                                        mimetype=f'multipart/byteranges; boundary={boundary}')
+                else:
+                    response = single_range_response(f, ranges, size, mime, throttled, res)
+            except BaseException:
+                f.close()
+                raise
+    response.headers['Accept-Ranges'] = 'bytes'
+    response.set_etag(etag)
+    response.last_modified = st.st_mtime
+    return response
+
+def single_range_response(f, ranges, size, mime, throttled, res):
+    start, stop = ranges[0] if ranges else (0, size)
+    advise(f.fileno(), start, stop - start)
+    wrapper = request.environ.get('wsgi.file_wrapper')
+    if STREAM_OFFLOAD == 'sendfile' and wrapper is not None and not throttled:
+        # The server sends Content-Length bytes from the current offset (os.sendfile under gunicorn)
+        os.lseek(f.fileno(), start, os.SEEK_SET)
+        body = wrapper(f, STREAM_CHUNK)
+    else:
+        chunks = iter_range(f.fileno(), start, stop, f.chunk)
+        if throttled: chunks = iter_paced(chunks, f.client, res)
+        body = StreamBody(f, chunks)
+    response = Response(body, status=206 if ranges else 200, mimetype=mime, direct_passthrough=True)
+    response.content_length = stop - start
+    if ranges: response.headers['Content-Range'] = f"bytes {start}-{stop - 1}/{size}"
+    return response
 
 @anisub_bp.route('/stream/<path:folder_name>/<path:video_name>')
 def stream_video(folder_name, video_name):
@@ -475,44 +1273,990 @@ def stream_video(folder_name, video_name):
 
     # Base directory for the show
     folder_path = os.path.join(BASE_DIR, folder_name)
+    show = library.get(folder_name)
+    if show is None: abort(404)
 
-    # Determine the actual file path
-    if requested_res != 'original':
-        # Look inside the subfolder (e.g., "Yuru Camp/240p/video.mp4")
+    # Look inside the subfolder (e.g., "Yuru Camp/240p/video.mp4"), falling
+    # back to the original if the specific resolution file doesn't exist
+    rendition = show['res'].get(requested_res)
+    if rendition and video_name in rendition['files']:
         target_path = os.path.join(folder_path, requested_res, video_name)
-
-        # Fallback to original if the specific resolution file doesn't exist
-        if not os.path.exists(target_path):
-            target_path = os.path.join(folder_path, video_name)
-    else:
+        res_label = requested_res
+    elif video_name in show['episodes']:
         target_path = os.path.join(folder_path, video_name)
-
-    if not os.path.exists(target_path):
+        res_label = 'original'
+    else:
         abort(404)
 
-    # Use your existing range-request helper or send_file
-    return send_from_directory(os.path.dirname(target_path), os.path.basename(target_path))
+    return stream_file(target_path, res_label)
+
+@anisub_bp.route('/stream_status')
+def stream_status():
+    return jsonify(stream_scheduler.stats())
+
+def poster_thumbnail(path, width, fmt):
+    key = cache_key(path)
+    thumb_path = os.path.join(CACHE_DIR, 'posters', f'{key}_{width}.{fmt}')
+    if os.path.exists(thumb_path): return key, thumb_path
+    try:
+        data = run_media(media.resize_image, path, width, fmt)
+    except MediaTimeout:
+        return key, None  # served the original poster this time
+    if data is None: return key, None
+    atomic_write(thumb_path, data)
+    return key, thumb_path
 
 @anisub_bp.route('/poster_file/<path:folder_name>/<path:filename>')
 def serve_poster(folder_name, filename):
     folder_name, filename = unquote(folder_name), unquote(filename)
     path = os.path.join(BASE_DIR, folder_name, filename)
     if not os.path.exists(path): abort(404)
+    width = request.args.get('w', type=int)
+    fmt = request.args.get('fmt', 'jpg')
+    if width in POSTER_WIDTHS and fmt in ('jpg', 'webp'):
+        key, thumb_path = poster_thumbnail(path, width, fmt)
+        if thumb_path:
+            # Versioned URL: safe to cache forever. Stale versions only get a short lifetime.
+            immutable = request.args.get('v') == key[:12]
+            response = send_file(thumb_path, mimetype=f'image/{"jpeg" if fmt == "jpg" else fmt}',
+                                 max_age=31536000 if immutable else 300)
+            if immutable: response.cache_control.immutable = True
+            return response
     # Automatically detect if it's jpg, png, or webp
     mime = mimetypes.guess_type(path)[0] or 'image/jpeg'
-    return send_file(path, mimetype=mime)
+    return send_file(path, mimetype=mime, max_age=3600)
+
+# --- ADAPTIVE HLS ---
+video_probes = {}
+hls_lock = threading.Lock()
+hls_jobs = {}
+hls_failed = set()
+hls_slots = threading.Semaphore(HLS_MAX_JOBS)
+
+def ffmpeg_available():
+    return shutil.which(FFMPEG) is not None
+
+def probe_video(path, background=False):
+    key = cache_key(path)
+    info = video_probes.get(key)
+    if info is None:
+        info = video_probes[key] = run_media(media.probe_video, path, background=background)
+    return info
+
+def hls_dir(key):
+    return os.path.join(CACHE_DIR, 'hls', key)
+
+def episode_renditions(folder_name, video_name):
+    # Original first, then every resolution folder that has this episode
+    show = library.get(folder_name)
+    if show is None or video_name not in show['episodes']: return None
+    folder_path = os.path.join(BASE_DIR, folder_name)
+    paths = [os.path.join(folder_path, video_name)]
+    paths += [os.path.join(folder_path, r, video_name) for r, info in show['res'].items() if video_name in info['files']]
+    return paths
+
+def hls_prepare(path):
+    # Cache dir for a rendition, with the source path the rendition route reads back
+    key = cache_key(path)
+    out_dir = hls_dir(key)
+    if not os.path.exists(os.path.join(out_dir, 'source')):
+        os.makedirs(out_dir, exist_ok=True)
+        with open(os.path.join(out_dir, 'source'), 'w') as f: f.write(path)
+    return key
+
+def hls_ready_renditions(folder_name, video_name):
+    # Fully packaged renditions; the rest are packaged in the background meanwhile. A rendition
+    # still being packaged is a growing EVENT playlist whose duration is only what's done so
+    # far, which would break resume, progress and prefetch, so the player uses /stream until then
+    ready = []
+    for path in episode_renditions(folder_name, video_name) or []:
+        key = cache_key(path)
+        if key in hls_failed: continue
+        hls_prepare(path)
+        if os.path.exists(os.path.join(hls_dir(key), 'complete')): ready.append((key, path))
+        else: start_hls_job(key, path)
+    return ready
+
+def start_hls_job(key, source):
+    with hls_lock:
+        if key in hls_jobs or key in hls_failed: return
+        if os.path.exists(os.path.join(hls_dir(key), 'complete')): return
+        hls_jobs[key] = threading.Thread(target=run_hls_job, args=(key, source), name=f'hls-{key}', daemon=True)
+        hls_jobs[key].start()
+
+def run_hls_job(key, source):
+    out_dir = hls_dir(key)
+    lock_file = None
+    try:
+        with hls_slots:
+            # Another worker process may already be packaging this rendition
+            lock_file = open(os.path.join(out_dir, 'lock'), 'w')
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return
+            if os.path.exists(os.path.join(out_dir, 'complete')): return
+            # Leftovers from an interrupted run are not resumable, start over
+            for name in os.listdir(out_dir):
+                if name not in ('source', 'lock'): os.remove(os.path.join(out_dir, name))
+            cmd = [FFMPEG, '-nostdin', '-loglevel', 'error', '-y', '-i', source,
+                   '-map', '0:v:0', '-map', '0:a:0?', '-c', 'copy', '-sn', '-dn',
+                   '-f', 'hls', '-hls_time', str(HLS_SEGMENT_SECONDS), '-hls_playlist_type', 'event',
+                   '-hls_segment_type', 'fmp4', '-hls_fmp4_init_filename', 'init.mp4',
+                   '-hls_flags', 'temp_file', '-hls_segment_filename', os.path.join(out_dir, 'seg_%05d.m4s'),
+                   os.path.join(out_dir, 'index.m3u8')]
+            result = subprocess.run(background_cmd(cmd), stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        if result.returncode != 0:
+            raise RuntimeError(result.stderr.decode(errors='replace').strip()[-500:])
+        open(os.path.join(out_dir, 'complete'), 'w').close()
+    except Exception:
+        log.exception("HLS packaging failed for %s", source)
+        with hls_lock: hls_failed.add(key)
+    finally:
+        if lock_file: lock_file.close()
+        with hls_lock: del hls_jobs[key]
+        evict_hls_cache()
+
+def evict_hls_cache():
+    root = os.path.join(CACHE_DIR, 'hls')
+    dirs = []
+    for entry in os.scandir(root):
+        if not entry.is_dir(): continue
+        size = sum(f.stat().st_size for f in os.scandir(entry.path) if f.is_file())
+        dirs.append((entry.stat().st_mtime, size, entry.name))
+    total = sum(size for _, size, _ in dirs)
+    # Least recently served first; renditions being packaged are kept
+    for _, size, key in sorted(dirs):
+        if total <= HLS_CACHE_BYTES: break
+        with hls_lock:
+            if key in hls_jobs: continue
+        try:
+            with open(os.path.join(hls_dir(key), 'lock'), 'w') as f:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                shutil.rmtree(hls_dir(key), ignore_errors=True)
+        except OSError:
+            continue
+        total -= size
+
+@anisub_bp.route('/hls/<path:folder_name>/<path:video_name>')
+def hls_master(folder_name, video_name):
+    if not ffmpeg_available(): abort(404)
+    lines = ["#EXTM3U", "#EXT-X-VERSION:7", "#EXT-X-INDEPENDENT-SEGMENTS"]
+    for key, path in hls_ready_renditions(unquote(folder_name), unquote(video_name)):
+        try:
+            info = probe_video(path)
+        except MediaTimeout:
+            return Response("", status=503, headers={'Retry-After': '1'})
+        if not info['height']: continue
+        bandwidth = int(os.path.getsize(path) * 8 / info['duration']) if info['duration'] else 1000000
+        lines.append(f"#EXT-X-STREAM-INF:BANDWIDTH={bandwidth},RESOLUTION={info['width']}x{info['height']}")
+        lines.append(f"{BASE_PATH}/hls_rendition/{key}/index.m3u8")
+    if len(lines) == 3: abort(404)
+    response = Response("\n".join(lines) + "\n", mimetype='application/vnd.apple.mpegurl')
+    response.cache_control.no_cache = True
+    return response
+
+@anisub_bp.route('/hls_rendition/<key>/<name>')
+def hls_rendition(key, name):
+    if not all(ch in '0123456789abcdef' for ch in key): abort(404)
+    out_dir = hls_dir(key)
+    try:
+        with open(os.path.join(out_dir, 'source')) as f: source = f.read()
+    except OSError:
+        abort(404)
+    complete = os.path.exists(os.path.join(out_dir, 'complete'))
+    if name not in ('index.m3u8', 'init.mp4') and not (name.startswith('seg_') and name.endswith('.m4s')): abort(404)
+    if not complete: start_hls_job(key, source)
+    # Mark as recently used for the LRU
+    os.utime(out_dir)
+    if name == 'index.m3u8':
+        playlist = os.path.join(out_dir, name)
+        deadline = time.monotonic() + 20
+        while not os.path.exists(playlist) and time.monotonic() < deadline:
+            if key in hls_failed: abort(404)
+            time.sleep(0.25)
+        if not os.path.exists(playlist): abort(503)
+        # While packaging is running this is an EVENT playlist the client keeps polling
+        response = send_from_directory(out_dir, name, mimetype='application/vnd.apple.mpegurl', max_age=0)
+        if not complete: response.cache_control.no_store = True
+        return response
+    return send_from_directory(out_dir, name, max_age=31536000)
+
+# --- TRANSCODING ---
+# 8-bit 4:2:0 output: 10-bit anime sources would otherwise give High 10 H.264 / VP9 profile 2,
+# which most browsers and phones can't decode
+X264_ARGS = ['-c:v', 'libx264', '-preset', 'veryfast', '-crf', '23', '-pix_fmt', 'yuv420p', '-profile:v', 'high']
+TRANSCODE_FORMATS = {
+    '.mp4': ('mp4', [*X264_ARGS, '-c:a', 'aac', '-b:a', '128k', '-movflags', '+faststart']),
+    '.mkv': ('matroska', [*X264_ARGS, '-c:a', 'aac', '-b:a', '128k']),
+    '.webm': ('webm', ['-c:v', 'libvpx-vp9', '-b:v', '0', '-crf', '33', '-row-mt', '1', '-pix_fmt', 'yuv420p',
+                       '-c:a', 'libopus', '-b:a', '96k']),
+}
+
+class Transcoder:
+    # Fills in missing TRANSCODE_TARGETS renditions with a small pool of niced ffmpeg
+    # workers. The queue is persisted so interrupted jobs are picked up again first
+    # after a restart; only one process per cache dir runs it (flock).
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = deque()
+        self.queued = set()
+        self.active = {}
+        self.skipped = set()
+        self.failed = {}
+        self.completed = 0
+        self.started = False
+        self.owner = False
+        self.wakeup = threading.Event()
+
+    def state_path(self):
+        return os.path.join(CACHE_DIR, 'transcode.json')
+
+    def ensure_started(self):
+        if self.started: return
+        with self.lock:
+            if self.started: return
+            self.started = True
+            if not TRANSCODE_TARGETS or not ffmpeg_available(): return
+            try:
+                os.makedirs(CACHE_DIR, exist_ok=True)
+                self.lock_file = open(os.path.join(CACHE_DIR, 'transcode.lock'), 'w')
+                fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return
+            self.owner = True
+            self.load_state()
+        threading.Thread(target=self.scan_loop, name='transcode-scan', daemon=True).start()
+        for i in range(TRANSCODE_WORKERS):
+            threading.Thread(target=self.worker_loop, name=f'transcode-{i}', daemon=True).start()
+
+    def load_state(self):
+        try:
+            with open(self.state_path()) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return
+        self.skipped = set(state.get('skipped', []))
+        for job in state.get('active', []) + state.get('pending', []):
+            self.enqueue(job)
+
+    def save_state(self):
+        state = {
+            'active': [a['job'] for a in self.active.values()],
+            'pending': list(self.pending),
+            'skipped': sorted(self.skipped),
+        }
+        try:
+            atomic_write_json(self.state_path(), state)
+        except OSError as e:
+            log.warning("could not save transcode state: %s", e)
+
+    def job_id(self, job):
+        return f"{job['show']}/{job['res']}/{job['episode']}"
+
+    def enqueue(self, job):
+        job_id = self.job_id(job)
+        if job_id in self.queued or job_id in self.active or job_id in self.skipped or job_id in self.failed: return False
+        self.queued.add(job_id)
+        self.pending.append(job)
+        return True
+
+    def scan_loop(self):
+        while True:
+            try:
+                self.scan()
+            except Exception:
+                log.exception("transcode scan failed")
+            time.sleep(TRANSCODE_SCAN_INTERVAL)
+
+    def scan(self):
+        added = False
+        for show_name in library.show_names():
+            show = library.get(show_name)
+            if show is None: continue
+            for res in TRANSCODE_TARGETS:
+                have = set(show['res'][res]['files']) if res in show['res'] else set()
+                for episode in show['episodes']:
+                    if episode in have or os.path.splitext(episode)[1].lower() not in TRANSCODE_FORMATS: continue
+                    with self.lock:
+                        added |= self.enqueue({'show': show_name, 'res': res, 'episode': episode})
+        if added:
+            with self.lock: self.save_state()
+            self.wakeup.set()
+
+    def worker_loop(self):
+        while True:
+            with self.lock:
+                job = self.pending.popleft() if self.pending else None
+                if job:
+                    job_id = self.job_id(job)
+                    self.queued.discard(job_id)
+                    self.active[job_id] = {'job': job, 'progress': 0.0, 'started': time.time()}
+                    self.save_state()
+            if job is None:
+                self.wakeup.wait(30)
+                self.wakeup.clear()
+                continue
+            try:
+                self.run(job_id, job)
+            except Exception as e:
+                log.exception("transcode %s failed", job_id)
+                with self.lock: self.failed[job_id] = str(e)[-300:]
+            finally:
+                with self.lock:
+                    del self.active[job_id]
+                    self.save_state()
+
+    def run(self, job_id, job):
+        folder_path = os.path.join(BASE_DIR, job['show'])
+        source = os.path.join(folder_path, job['episode'])
+        out_dir = os.path.join(folder_path, job['res'])
+        target = os.path.join(out_dir, job['episode'])
+        if os.path.exists(target) or not os.path.exists(source): return
+        info = probe_video(source, background=True)
+        height = int(job['res'][:-1])
+        if not info['height'] or info['height'] <= height:
+            # Never upscale; remember so the scanner doesn't queue it again
+            with self.lock: self.skipped.add(job_id)
+            return
+        fmt, codec_args = TRANSCODE_FORMATS[os.path.splitext(job['episode'])[1].lower()]
+        os.makedirs(out_dir, exist_ok=True)
+        # Hidden partial file so the library never lists it; swapped in atomically when done
+        part = os.path.join(out_dir, f".{job['episode']}.part")
+        cmd = [FFMPEG, '-nostdin', '-loglevel', 'error', '-y', '-i', source,
+               '-map', '0:v:0', '-map', '0:a:0?', '-sn', '-dn', '-vf', f'scale=-2:{height}',
+               *codec_args, '-progress', 'pipe:1', '-nostats', '-f', fmt, part]
+        proc = subprocess.Popen(background_cmd(cmd), stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                preexec_fn=lambda: os.nice(TRANSCODE_NICE))
+        try:
+            for line in proc.stdout:
+                key, _, value = line.decode(errors='replace').strip().partition('=')
+                if key == 'out_time_us' and value.isdigit() and info['duration']:
+                    with self.lock:
+                        self.active[job_id]['progress'] = min(1.0, int(value) / 1e6 / info['duration'])
+            stderr = proc.stderr.read()
+            if proc.wait() != 0:
+                raise RuntimeError(stderr.decode(errors='replace').strip())
+            os.replace(part, target)
+            with self.lock: self.completed += 1
+        finally:
+            if proc.poll() is None: proc.kill()
+            if os.path.exists(part): os.remove(part)
+
+    def status(self):
+        with self.lock:
+            return {
+                'enabled': self.owner,
+                'targets': TRANSCODE_TARGETS,
+                'workers': TRANSCODE_WORKERS,
+                'queue_depth': len(self.pending),
+                'active': [{'job': job_id, 'progress': round(a['progress'], 3), 'elapsed': round(time.time() - a['started'], 1)}
+                           for job_id, a in self.active.items()],
+                'completed': self.completed,
+                'skipped': len(self.skipped),
+                'failed': self.failed,
+            }
+
+transcoder = Transcoder()
+
+@anisub_bp.route('/transcode_status')
+def transcode_status():
+    return jsonify(transcoder.status())
+
+# --- SUBTITLES ---
+SRT_TIME_RE = re.compile(r'^\s*(\d+):(\d{1,2}):(\d{1,2})[,.](\d{1,3})\s*-->\s*(\d+):(\d{1,2}):(\d{1,2})[,.](\d{1,3})')
+
+def decode_subtitle(raw):
+    for bom, enc in ((codecs.BOM_UTF8, 'utf-8'), (codecs.BOM_UTF16_LE, 'utf-16-le'), (codecs.BOM_UTF16_BE, 'utf-16-be')):
+        if raw.startswith(bom): return raw[len(bom):].decode(enc, errors='replace')
+    for enc in SUB_ENCODINGS:
+        try: return raw.decode(enc.strip())
+        except (UnicodeDecodeError, LookupError): continue
+    return raw.decode('latin-1')
+
+def srt_to_vtt(lines):
+    # Only timing lines are rewritten; commas in dialogue are left alone
+    yield "WEBVTT\n\n"
+    for line in lines:
+        line = line.rstrip('\r\n')
+        m = SRT_TIME_RE.match(line)
+        if m:
+            h1, m1, s1, ms1, h2, m2, s2, ms2 = m.groups()
+            line = f"{int(h1):02d}:{int(m1):02d}:{int(s1):02d}.{ms1.ljust(3, '0')} --> {int(h2):02d}:{int(m2):02d}:{int(s2):02d}.{ms2.ljust(3, '0')}"
+        yield line + "\n"
+
+class SubtitleCache:
+    # LRU of converted subtitles keyed by path, validated against mtime and bounded by total bytes
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.total = 0
+        self.counters = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def get(self, path):
+        st = os.stat(path)
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry and entry['mtime_ns'] == st.st_mtime_ns and entry['size'] == st.st_size:
+                self.entries.move_to_end(path)
+                self.counters['hits'] += 1
+                return entry
+            self.counters['misses'] += 1
+        with open(path, 'rb') as f:
+            text = decode_subtitle(f.read())
+        body = ''.join(srt_to_vtt(text.splitlines())).encode('utf-8')
+        entry = {
+            'mtime_ns': st.st_mtime_ns, 'size': st.st_size, 'mtime': st.st_mtime,
+            'etag': hashlib.sha1(body).hexdigest()[:20],
+            'identity': body, 'gzip': gzip.compress(body, 6),
+            'br': brotli.compress(body) if brotli else None,
+        }
+        with self.lock:
+            self._remove(path)
+            self.entries[path] = entry
+            self.total += self._weight(entry)
+            while self.total > self.max_bytes and len(self.entries) > 1:
+                self._remove(next(iter(self.entries)))
+                self.counters['evictions'] += 1
+        return entry
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, entries=len(self.entries), bytes=self.total)
+
+    def _weight(self, entry):
+        return sum(len(entry[k]) for k in ('identity', 'gzip', 'br') if entry[k])
+
+    def _remove(self, path):
+        entry = self.entries.pop(path, None)
+        if entry: self.total -= self._weight(entry)
+
+subtitle_cache = SubtitleCache(SUB_CACHE_BYTES)
 
 @anisub_bp.route('/sub/<path:folder_name>/<path:srt_name>')
 def serve_subs(folder_name, srt_name):
     folder_name, srt_name = unquote(folder_name), unquote(srt_name)
     path = os.path.join(BASE_DIR, folder_name, srt_name)
     if not os.path.exists(path): return abort(404)
-    with open(path, 'r', encoding='utf-8', errors='ignore') as f:
-        srt_content = f.read()
-    vtt_content = "WEBVTT\n\n" + srt_content.replace(',', '.')
-    return Response(vtt_content, mimetype='text/vtt')
+    entry = subtitle_cache.get(path)
+    accepted = request.accept_encodings
+    encoding = 'br' if entry['br'] and accepted['br'] else 'gzip' if accepted['gzip'] else 'identity'
+    response = Response(entry[encoding], mimetype='text/vtt')
+    if encoding != 'identity': response.headers['Content-Encoding'] = encoding
+    response.headers['Vary'] = 'Accept-Encoding'
+    # Strong ETag per representation; the browser revalidates and gets a 304 when unchanged
+    response.set_etag(f"{entry['etag']}-{encoding}")
+    response.last_modified = entry['mtime']
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+def list_subtitle_streams(path):
+    # [{'index', 'codec', 'language', 'title', 'default'}] for each subtitle stream
+    if shutil.which(FFPROBE):
+        out = subprocess.run([FFPROBE, '-v', 'error', '-select_streams', 's', '-show_entries',
+                              'stream=index,codec_name:stream_tags=language,title:stream_disposition=default',
+                              '-of', 'json', path], capture_output=True, text=True, timeout=60, check=True).stdout
+        return [{'index': st['index'], 'codec': st.get('codec_name'),
+                 'language': st.get('tags', {}).get('language'), 'title': st.get('tags', {}).get('title'),
+                 'default': bool(st.get('disposition', {}).get('default'))}
+                for st in json.loads(out).get('streams', [])]
+    # ffmpeg alone: parse the stream list it prints for -i
+    err = subprocess.run([FFMPEG, '-hide_banner', '-nostdin', '-i', path], capture_output=True, text=True, timeout=60).stderr
+    streams = []
+    for match in re.finditer(r'Stream #0:(\d+)(?:\[\w+\])?(?:\((\w+)\))?: Subtitle: (\w+)(.*)', err):
+        streams.append({'index': int(match.group(1)), 'codec': match.group(3), 'language': match.group(2),
+                        'title': None, 'default': '(default)' in match.group(4)})
+    return streams
+
+class SubtitleExtractor:
+    # Embedded text subtitle tracks, extracted once per file with a single ffmpeg pass into
+    # CACHE_DIR/subtitles/<cache_key>/ (track_N.vtt plus tracks.json, moved into place last).
+    # Never runs on the request path: a background thread takes one file at a time at
+    # TRANSCODE_NICE and waits while streams are busy; an flock keeps gunicorn workers
+    # from extracting the same file twice.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.manifests = {}
+        self.failed = set()  # keys ffmpeg failed on; the key changes with the file, so fixed files are retried
+        self.jobs = BackgroundQueue('subtitle-extract', self.process)
+        self.counters = {'extracted': 0, 'failed': 0, 'throttled': 0}
+
+    def dir(self, key):
+        return os.path.join(CACHE_DIR, 'subtitles', key)
+
+    def tracks(self, video_path):
+        # (key, manifest), or (key, None) while extraction is still pending; no embedded
+        # tracks ([]) without ffmpeg or when extraction failed for this file
+        key = cache_key(video_path)
+        with self.lock:
+            manifest = self.manifests.get(key)
+            if manifest is None and key in self.failed: manifest = []
+        if manifest is not None: return key, manifest
+        try:
+            with open(os.path.join(self.dir(key), 'tracks.json')) as f: manifest = json.load(f)
+        except (OSError, ValueError):
+            if not ffmpeg_available(): return key, []
+            self.enqueue(video_path, key)
+            return key, None
+        with self.lock: self.manifests[key] = manifest
+        return key, manifest
+
+    def enqueue(self, video_path, key=None):
+        if not ffmpeg_available(): return
+        key = key or cache_key(video_path)
+        with self.lock:
+            if key in self.manifests or key in self.failed: return
+        self.jobs.put(key, video_path, key)
+
+    def process(self, video_path, key):
+        self.wait_for_idle()
+        try:
+            self.extract(video_path, key)
+        except Exception:
+            with self.lock:
+                self.failed.add(key)
+                self.counters['failed'] += 1
+            raise
+
+    def wait_for_idle(self):
+        # Give way to active streams, but not forever
+        deadline = time.monotonic() + 300
+        while metrics.get('anisub_active_streams') > SUB_EXTRACT_MAX_STREAMS and time.monotonic() < deadline:
+            with self.lock: self.counters['throttled'] += 1
+            time.sleep(5)
+
+    def extract(self, video_path, key):
+        out_dir = self.dir(key)
+        if os.path.exists(os.path.join(out_dir, 'tracks.json')): return
+        os.makedirs(os.path.dirname(out_dir), exist_ok=True)
+        with open(f'{out_dir}.lock', 'w') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return  # another worker is on it
+            streams = [st for st in list_subtitle_streams(video_path) if st['codec'] in TEXT_SUB_CODECS]
+            tmp_dir = f'{out_dir}.{os.getpid()}.tmp'
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            os.makedirs(tmp_dir)
+            if streams:
+                cmd = [FFMPEG, '-v', 'error', '-nostdin', '-y', '-i', video_path]
+                for n, st in enumerate(streams):
+                    cmd += ['-map', f'0:{st["index"]}', '-c:s', 'webvtt', '-f', 'webvtt', os.path.join(tmp_dir, f'track_{n}.vtt')]
+                subprocess.run(background_cmd(cmd), capture_output=True, timeout=1800, check=True,
+                               preexec_fn=lambda: os.nice(TRANSCODE_NICE))
+            manifest = [{'id': n, 'language': st['language'], 'title': st['title'], 'codec': st['codec'],
+                         'default': st['default']} for n, st in enumerate(streams)]
+            with open(os.path.join(tmp_dir, 'tracks.json'), 'w') as f: json.dump(manifest, f)
+            shutil.rmtree(out_dir, ignore_errors=True)
+            os.replace(tmp_dir, out_dir)
+        with self.lock:
+            self.manifests[key] = manifest
+            self.counters['extracted'] += 1
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, files=len(self.manifests), pending=len(self.jobs))
+
+subtitle_extractor = SubtitleExtractor()
+
+def subtitle_tracks(folder_name, video_name):
+    # Sidecar .srt first, then any extracted embedded tracks; pending is True while
+    # extraction hasn't finished yet
+    show = library.get(folder_name)
+    tracks = []
+    srt_name = os.path.splitext(video_name)[0] + ".srt"
+    if srt_name in show['subs']:
+        tracks.append({'label': 'SRT', 'language': None, 'default': True,
+                       'src': f'{BASE_PATH}/sub/{quote(folder_name)}/{quote(srt_name)}'})
+    key, manifest = subtitle_extractor.tracks(os.path.join(BASE_DIR, folder_name, video_name))
+    for track in manifest or ():
+        label = ' · '.join(p for p in (track['language'], track['title']) if p) or f"Track {track['id'] + 1}"
+        tracks.append({'label': label, 'language': track['language'], 'default': track['default'] and not any(t['default'] for t in tracks),
+                       'src': f'{BASE_PATH}/subtitle_track/{key}/track_{track["id"]}.vtt'})
+    return tracks, manifest is None
+
+@anisub_bp.route('/subtitle_tracks/<path:folder_name>/<path:video_name>')
+def list_subtitle_tracks(folder_name, video_name):
+    folder_name, video_name = unquote(folder_name), unquote(video_name)
+    show = library.get(folder_name)
+    if show is None or video_name not in show['order']: abort(404)
+    tracks, pending = subtitle_tracks(folder_name, video_name)
+    return jsonify(tracks=tracks, pending=pending)
+
+@anisub_bp.route('/subtitle_track/<key>/<name>')
+def serve_subtitle_track(key, name):
+    if not all(ch in '0123456789abcdef' for ch in key) or not re.fullmatch(r'track_\d+\.vtt', name): abort(404)
+    # Keyed by the episode's size + mtime, so the content at this URL never changes
+    return send_from_directory(subtitle_extractor.dir(key), name, mimetype='text/vtt', max_age=31536000)
+
+# --- NEXT-EPISODE WARMUP ---
+class Prefetcher:
+    # Progress heartbeats past PREFETCH_AT queue the next episode here. A background thread
+    # asks the kernel to read the head (and tail, where MP4s often keep the moov atom) of the
+    # file the viewer will stream, converts its subtitles into subtitle_cache and queues its
+    # sprites and keyframe index, so pressing "next" doesn't wait on a cold disk.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.jobs = BackgroundQueue('prefetch', self.process)
+        self.recent = OrderedDict()  # (show, episode, res) already warmed, bounded
+        self.counters = {'requested': 0, 'warmed': 0, 'failed': 0}
+
+    def request(self, show, episode, res):
+        target = next_episode(show, episode)
+        if target is None: return
+        key = (show, target, res or 'original')
+        with self.lock:
+            if key in self.recent: return
+            self.recent[key] = True
+            while len(self.recent) > 256: self.recent.popitem(last=False)
+            self.counters['requested'] += 1
+        self.jobs.put(key, *key)
+
+    def process(self, folder_name, video_name, res):
+        try:
+            self.warm(folder_name, video_name, res)
+        except Exception:
+            with self.lock: self.counters['failed'] += 1
+            raise
+        with self.lock: self.counters['warmed'] += 1
+
+    def warm(self, folder_name, video_name, res):
+        show = library.get(folder_name)
+        if show is None: return
+        folder_path = os.path.join(BASE_DIR, folder_name)
+        source = os.path.join(folder_path, video_name)
+        rendition = show['res'].get(res)
+        target = os.path.join(folder_path, res, video_name) if rendition and video_name in rendition['files'] else source
+        with open(target, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(f.fileno(), 0, min(size, PREFETCH_BYTES), os.POSIX_FADV_WILLNEED)
+                os.posix_fadvise(f.fileno(), max(0, size - STREAM_CHUNK), STREAM_CHUNK, os.POSIX_FADV_WILLNEED)
+        srt_name = os.path.splitext(video_name)[0] + ".srt"
+        if srt_name in show['subs']: subtitle_cache.get(os.path.join(folder_path, srt_name))
+        queue_sprites(source)
+        keyframes.enqueue(source)
+        subtitle_extractor.enqueue(source)
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, queue_depth=len(self.jobs))
+
+def next_episode(folder_name, video_name):
+    show = library.get(folder_name)
+    idx = show['order'].get(video_name) if show else None
+    if idx is None or idx + 1 >= len(show['episodes']): return None
+    return show['episodes'][idx + 1]
+
+prefetcher = Prefetcher()
+
+@anisub_bp.route('/prefetch_status')
+def prefetch_status():
+    return jsonify(prefetcher.stats())
+
+# --- WATCH PROGRESS ---
+class ProgressStore:
+    # Heartbeats only update an in-memory dict (the latest one per episode wins);
+    # a flusher thread writes them all in one transaction every PROGRESS_FLUSH_INTERVAL.
+    # Reads overlay the not-yet-flushed entries, so they always see the latest position.
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.pending_prefs = {}
+        self.flusher = None
+        self.counters = {'heartbeats': 0, 'flushes': 0, 'rows_written': 0}
+
+    def db(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS progress (
+                    profile TEXT NOT NULL, show TEXT NOT NULL, episode TEXT NOT NULL,
+                    position REAL NOT NULL, duration REAL, updated REAL NOT NULL,
+                    PRIMARY KEY (profile, show, episode));
+                CREATE INDEX IF NOT EXISTS progress_recent ON progress (profile, updated);
+                CREATE TABLE IF NOT EXISTS preferences (
+                    profile TEXT NOT NULL, key TEXT NOT NULL, value TEXT,
+                    PRIMARY KEY (profile, key));
+            """)
+            self.local.conn = conn
+        return conn
+
+    def record(self, profile, show, episode, position, duration):
+        with self.lock:
+            self.pending[(profile, show, episode)] = (position, duration, time.time())
+            self.counters['heartbeats'] += 1
+            if self.flusher is None:
+                self.flusher = threading.Thread(target=self.flush_loop, name='progress-flush', daemon=True)
+                self.flusher.start()
+
+    def set_preference(self, profile, key, value):
+        with self.lock: self.pending_prefs[(profile, key)] = value
+        self.flush()
+
+    def flush_loop(self):
+        while True:
+            time.sleep(PROGRESS_FLUSH_INTERVAL)
+            try:
+                self.flush()
+            except sqlite3.Error:
+                log.exception("progress flush failed")
+
+    def flush(self):
+        with self.lock:
+            rows, self.pending = self.pending, {}
+            prefs, self.pending_prefs = self.pending_prefs, {}
+        if not rows and not prefs: return
+        try:
+            conn = self.db()
+            with conn:
+                conn.executemany(
+                    "INSERT INTO progress (profile, show, episode, position, duration, updated) VALUES (?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT (profile, show, episode) DO UPDATE SET position=excluded.position, "
+                    "duration=excluded.duration, updated=excluded.updated WHERE excluded.updated >= progress.updated",
+                    [(p, s, e, pos, dur, ts) for (p, s, e), (pos, dur, ts) in rows.items()])
+                conn.executemany(
+                    "INSERT OR REPLACE INTO preferences (profile, key, value) VALUES (?, ?, ?)",
+                    [(p, k, v) for (p, k), v in prefs.items()])
+        except Exception:
+            # Rolled back: keep the batch for the next flush, unless a newer heartbeat came in
+            with self.lock:
+                self.pending = {**rows, **self.pending}
+                self.pending_prefs = {**prefs, **self.pending_prefs}
+            raise
+        with self.lock:
+            self.counters['flushes'] += 1
+            self.counters['rows_written'] += len(rows)
+
+    def _overlay(self, profile, show=None):
+        with self.lock:
+            return {(s, e): v for (p, s, e), v in self.pending.items() if p == profile and (show is None or s == show)}
+
+    def show_progress(self, profile, show):
+        # {episode: {'position', 'duration', 'updated'}} for one show
+        rows = self.db().execute(
+            "SELECT episode, position, duration, updated FROM progress WHERE profile=? AND show=?", (profile, show)).fetchall()
+        result = {e: {'position': pos, 'duration': dur, 'updated': ts} for e, pos, dur, ts in rows}
+        for (_, e), (pos, dur, ts) in self._overlay(profile, show).items():
+            result[e] = {'position': pos, 'duration': dur, 'updated': ts}
+        return result
+
+    def last_episode(self, profile, show):
+        episodes = self.show_progress(profile, show)
+        if not episodes: return None, 0
+        episode = max(episodes, key=lambda e: episodes[e]['updated'])
+        return episode, episodes[episode]['position']
+
+    def recent_shows(self, profile, limit):
+        rows = self.db().execute(
+            "SELECT show, episode, position, duration, MAX(updated) FROM progress WHERE profile=? "
+            "GROUP BY show ORDER BY MAX(updated) DESC LIMIT ?", (profile, limit)).fetchall()
+        latest = {s: (e, pos, dur, ts) for s, e, pos, dur, ts in rows}
+        for (s, e), (pos, dur, ts) in self._overlay(profile).items():
+            if s not in latest or ts > latest[s][3]: latest[s] = (e, pos, dur, ts)
+        ordered = sorted(latest.items(), key=lambda item: item[1][3], reverse=True)[:limit]
+        return [{'show': s, 'episode': e, 'position': pos, 'duration': dur} for s, (e, pos, dur, ts) in ordered]
+
+    def preference(self, profile, key, default=None):
+        with self.lock:
+            if (profile, key) in self.pending_prefs: return self.pending_prefs[(profile, key)]
+        row = self.db().execute("SELECT value FROM preferences WHERE profile=? AND key=?", (profile, key)).fetchone()
+        return row[0] if row else default
+
+progress_store = ProgressStore(PROGRESS_DB)
+atexit.register(progress_store.flush)
+
+def current_profile():
+    # Everyone shares the "default" profile unless a client sets the anisub_profile cookie
+    return request.cookies.get('anisub_profile', 'default')[:64]
+
+@anisub_bp.route('/api/progress', methods=['POST'])
+def report_progress():
+    data = request.get_json(silent=True) or {}
+    try:
+        show, episode = str(data['show']), str(data['episode'])
+        position = float(data['position'])
+        duration = float(data['duration']) if data.get('duration') else None
+    except (KeyError, TypeError, ValueError):
+        abort(400)
+    # float() accepts "nan"/"inf"; SQLite would store NaN as NULL and fail the whole batch
+    if not math.isfinite(position) or position < 0: abort(400)
+    if duration is not None and (not math.isfinite(duration) or duration <= 0): abort(400)
+    entry = library.get(show)
+    if entry is None or episode not in entry['episodes']: abort(404)
+    profile = current_profile()
+    progress_store.record(profile, show, episode, position, duration)
+    if PREFETCH_AT > 0 and duration and position >= duration * PREFETCH_AT:
+        prefetcher.request(show, episode, progress_store.preference(profile, 'preferred_res'))
+    return Response(status=204)
+
+@anisub_bp.route('/api/progress/<path:folder_name>')
+def get_progress(folder_name):
+    folder_name = unquote(folder_name)
+    profile = current_profile()
+    last_ep, position = progress_store.last_episode(profile, folder_name)
+    return jsonify(last_episode=last_ep, position=position, episodes=progress_store.show_progress(profile, folder_name))
+
+@anisub_bp.route('/api/preferences', methods=['GET', 'POST'])
+def preferences():
+    profile = current_profile()
+    if request.method == 'POST':
+        res = (request.get_json(silent=True) or {}).get('preferred_res')
+        if not isinstance(res, str) or len(res) > 16: abort(400)
+        progress_store.set_preference(profile, 'preferred_res', res)
+    return jsonify(preferred_res=progress_store.preference(profile, 'preferred_res'))
+
+# --- METRICS ---
+class Metrics:
+    # Minimal in-process Prometheus registry: counters/gauges and fixed-bucket histograms.
+    # Each gunicorn worker keeps its own numbers (the pid is exported as a label).
+    HELP = {
+        'anisub_requests_total': ('counter', 'Requests by endpoint and status'),
+        'anisub_request_duration_seconds': ('histogram', 'Time to build the response, by endpoint'),
+        'anisub_stream_bytes_total': ('counter', 'Body bytes sent by /stream, by resolution folder (not proxy-offloaded responses)'),
+        'anisub_active_streams': ('gauge', 'Open /stream responses'),
+        'anisub_preview_stage_seconds': ('histogram', 'Preview decode/resize/encode time'),
+        'anisub_poster_placeholder_total': ('counter', 'Poster lookups that fell back to the placeholder'),
+    }
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}
+        self.histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock: self.values[key] = self.values.get(key, 0) + value
+
+    def get(self, name, **labels):
+        with self.lock: return self.values.get((name, tuple(sorted(labels.items()))), 0)
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            hist = self.histograms.get(key)
+            if hist is None: hist = self.histograms[key] = [[0] * len(LATENCY_BUCKETS), 0.0, 0]
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if value <= bound: hist[0][i] += 1
+            hist[1] += value
+            hist[2] += 1
+
+    def render(self, extra):
+        def fmt_labels(labels):
+            labels = dict(labels, pid=os.getpid())
+            return '{' + ','.join(f'{k}="{escape_label(v)}"' for k, v in labels.items()) + '}'
+        lines, described = [], set()
+        def describe(name, kind, text):
+            if name not in described:
+                lines.append(f"# HELP {name} {text}")
+                lines.append(f"# TYPE {name} {kind}")
+                described.add(name)
+        with self.lock:
+            values = sorted(self.values.items())
+            histograms = sorted((k, (list(h[0]), h[1], h[2])) for k, h in self.histograms.items())
+        for (name, labels), value in values + sorted(extra.items()):
+            kind, text = self.HELP.get(name, ('gauge', f"{name[len('anisub_'):].replace('_', ' ')} (component stats)"))
+            describe(name, kind, text)
+            lines.append(f"{name}{fmt_labels(labels)} {value}")
+        for (name, labels), (buckets, total, count) in histograms:
+            kind, text = self.HELP.get(name, ('histogram', name))
+            describe(name, kind, text)
+            for bound, n in zip(LATENCY_BUCKETS, buckets):
+                lines.append(f"{name}_bucket{fmt_labels(labels + (('le', bound),))} {n}")
+            lines.append(f"{name}_bucket{fmt_labels(labels + (('le', '+Inf'),))} {count}")
+            lines.append(f"{name}_sum{fmt_labels(labels)} {total}")
+            lines.append(f"{name}_count{fmt_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+metrics = Metrics()
+
+@anisub_bp.before_request
+def start_timer():
+    g.request_started = time.perf_counter()
+
+@anisub_bp.after_request
+def record_request(response):
+    if 'request_started' in g and request.endpoint != 'anisub.prometheus_metrics':
+        endpoint = request.endpoint or 'unknown'
+        metrics.inc('anisub_requests_total', endpoint=endpoint, method=request.method, status=response.status_code)
+        metrics.observe('anisub_request_duration_seconds', time.perf_counter() - g.request_started, endpoint=endpoint)
+    return response
+
+@anisub_bp.route('/metrics')
+def prometheus_metrics():
+    extra = {}
+    for key, value in preview_stats_values().items():
+        if key != 'pid': extra[(f'anisub_preview_pool_{key}', ())] = value
+    for key, value in subtitle_cache.stats().items():
+        extra[(f'anisub_subtitle_cache_{key}', ())] = value
+    for key, value in progress_store.counters.items():
+        extra[(f'anisub_progress_{key}', ())] = value
+    for key, value in prefetcher.stats().items():
+        extra[(f'anisub_prefetch_{key}', ())] = value
+    for key, value in episode_metadata.stats().items():
+        extra[(f'anisub_metadata_{key}', ())] = value
+    for key, value in subtitle_extractor.stats().items():
+        extra[(f'anisub_subtitle_extract_{key}', ())] = value
+    throttle = stream_scheduler.stats()
+    for key in ('rejected', 'paced_bytes', 'playback_bytes', 'wait_seconds'):
+        extra[(f'anisub_stream_throttle_{key}', ())] = throttle[key]
+    transcode = transcoder.status()
+    extra[('anisub_transcode_queue_depth', ())] = transcode['queue_depth']
+    extra[('anisub_transcode_active', ())] = len(transcode['active'])
+    extra[('anisub_library_shows', ())] = len(library.shows)
+    return Response(metrics.render(extra), mimetype='text/plain; version=0.0.4')
+
+# Sampling profiler: with ANISUB_PROFILER=1, /debug/profile?seconds=N samples every
+# thread's stack and returns folded stacks for flamegraph.pl / speedscope.
+profile_lock = threading.Lock()
+
+def sample_stacks(seconds):
+    folded = {}
+    me = threading.get_ident()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == me: continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            key = ';'.join(reversed(stack))
+            folded[key] = folded.get(key, 0) + 1
+        time.sleep(PROFILER_INTERVAL)
+    return folded
+
+@anisub_bp.route('/debug/profile')
+def debug_profile():
+    if not PROFILER_ENABLED: abort(404)
+    seconds = min(max(request.args.get('seconds', 10, type=float), 0.1), 120)
+    if not profile_lock.acquire(blocking=False): abort(409)
+    try:
+        folded = sample_stacks(seconds)
+    finally:
+        profile_lock.release()
+    body = "\n".join(f"{stack} {count}" for stack, count in sorted(folded.items(), key=lambda item: -item[1]))
+    return Response(body + "\n", mimetype='text/plain')
+
+@anisub_bp.before_app_request
+def start_background_services():
+    library.ensure_started()
+    transcoder.ensure_started()
 
 app.register_blueprint(anisub_bp)
 
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    start_background_services()
     app.run(host='0.0.0.0', port=5000, debug=True)
@@ -0,0 +1,292 @@
+"""Load and latency benchmark for the anisub routes.
+
+Generates a synthetic library (tiny OpenCV-encoded videos, resolution folders,
+SRTs and posters), starts the server against it and drives every hot route at a
+fixed concurrency. Latency percentiles, throughput and the server's peak RSS are
+written to a JSON file so runs (and server modes) can be compared.
+
+    python benchmark.py --mode gunicorn --shows 20 --episodes 12 --concurrency 16
+    python benchmark.py --mode dev --output dev.json
+    python benchmark.py --url http://nas:5000 --library /path/to/generated/lib
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import socket
+import argparse
+import tempfile
+import platform
+import threading
+import subprocess
+import http.client
+from urllib.parse import quote, urlsplit
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+BASE_PATH = "/侍の道"
+RESOLUTIONS = {'240p': (426, 240), '480p': (854, 480)}
+SRT_CUE = "{n}\n00:{m:02d}:{s:02d},000 --> 00:{m:02d}:{s:02d},900\nLine {n}, with a comma\n\n"
+
+
+# --- SYNTHETIC LIBRARY ---
+def write_video(path, size, seconds, fps=10):
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), fps, size)
+    frame = np.zeros((size[1], size[0], 3), np.uint8)
+    for i in range(seconds * fps):
+        frame[:] = (i * 3 % 255, i * 7 % 255, 90)
+        cv2.putText(frame, str(i), (10, size[1] // 2), cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2)
+        writer.write(frame)
+    writer.release()
+
+def generate_library(root, shows, episodes, seconds):
+    # One rendered clip per resolution, copied for every episode: generation stays fast
+    # and every file still has a distinct path/mtime for the server's caches
+    templates = {}
+    for name, size in [('original', (1280, 720))] + list(RESOLUTIONS.items()):
+        templates[name] = os.path.join(root, f'.template_{name}.mp4')
+        write_video(templates[name], size, seconds)
+    for s in range(shows):
+        show_dir = os.path.join(root, f'Show {s:03d}')
+        for res in RESOLUTIONS: os.makedirs(os.path.join(show_dir, res), exist_ok=True)
+        poster = np.full((900, 600, 3), (s * 37 % 255, 80, 160), np.uint8)
+        cv2.imwrite(os.path.join(show_dir, 'poster.jpg'), poster)
+        for e in range(1, episodes + 1):
+            name = f'Episode {e:02d}.mp4'
+            shutil.copyfile(templates['original'], os.path.join(show_dir, name))
+            for res in RESOLUTIONS: shutil.copyfile(templates[res], os.path.join(show_dir, res, name))
+            with open(os.path.join(show_dir, f'Episode {e:02d}.srt'), 'w') as f:
+                f.write(''.join(SRT_CUE.format(n=n + 1, m=n // 60, s=n % 60) for n in range(seconds)))
+    for path in templates.values(): os.remove(path)
+
+
+# --- SERVER ---
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def server_env(library, cache_dir, preview_workers):
+    return dict(os.environ, ANISUB_LIBRARY=library, ANISUB_CACHE_DIR=cache_dir, ANISUB_TRANSCODE_TARGETS='',
+                ANISUB_PREVIEW_WORKERS=str(preview_workers), PYTHONUNBUFFERED='1')
+
+def measure_import(env):
+    # Cold `import app` in a fresh interpreter: wall time, peak RSS and whether OpenCV got loaded
+    code = ("import sys, time, json, resource; started = time.perf_counter(); import app; "
+            "print(json.dumps({'import_sec': time.perf_counter() - started, "
+            "'import_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3, "
+            "'cv2_loaded': 'cv2' in sys.modules}))")
+    here = os.path.dirname(os.path.abspath(__file__))
+    out = subprocess.run([sys.executable, '-c', code], cwd=here, env=env, capture_output=True, text=True, check=True)
+    result = json.loads(out.stdout.strip().splitlines()[-1])
+    return {k: round(v, 3) if isinstance(v, float) else v for k, v in result.items()}
+
+def first_request_ms(base_url, path):
+    parts = urlsplit(base_url)
+    conn = http.client.HTTPConnection(parts.hostname, parts.port, timeout=60)
+    started = time.perf_counter()
+    conn.request('GET', quote(BASE_PATH) + path)
+    resp = conn.getresponse()
+    resp.read()
+    conn.close()
+    return round((time.perf_counter() - started) * 1000, 2), resp.status
+
+def start_server(mode, env, port):
+    env = dict(env, ANISUB_BIND=f'127.0.0.1:{port}')
+    here = os.path.dirname(os.path.abspath(__file__))
+    if mode == 'gunicorn':
+        cmd = [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', '--access-logfile', '/dev/null', 'app:app']
+    else:
+        cmd = [sys.executable, '-m', 'flask', '--app', 'app', 'run', '--host', '127.0.0.1', '--port', str(port), '--with-threads']
+    proc = subprocess.Popen(cmd, cwd=here, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.2).close()
+            return proc
+        except OSError:
+            if proc.poll() is not None: raise RuntimeError(f'server exited with {proc.returncode}')
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError('server did not start')
+
+def tree_rss(pid):
+    # Resident memory of a process and its children (gunicorn workers), in bytes
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit(): continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    total, stack = 0, [pid]
+    while stack:
+        p = stack.pop()
+        stack.extend(children.get(p, []))
+        try:
+            with open(f'/proc/{p}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'): total += int(line.split()[1]) * 1024
+        except OSError:
+            pass
+    return total
+
+class RssSampler(threading.Thread):
+    def __init__(self, pid):
+        super().__init__(daemon=True)
+        self.pid, self.peak, self.running = pid, 0, True
+
+    def run(self):
+        while self.running:
+            self.peak = max(self.peak, tree_rss(self.pid))
+            time.sleep(0.1)
+
+
+# --- LOAD ---
+def build_scenarios(shows, episodes, seconds):
+    def show(): return quote(f'Show {random.randrange(shows):03d}')
+    def episode(): return quote(f'Episode {random.randint(1, episodes):02d}.mp4')
+    def srt(): return quote(f'Episode {random.randint(1, episodes):02d}.srt')
+    def stream():
+        start = random.randrange(0, 65536)
+        res = random.choice(['', '?res=240p', '?res=480p'])
+        return f'/stream/{show()}/{episode()}{res}', {'Range': f'bytes={start}-{start + 262143}'}
+    return {
+        'index': lambda: ('/', {}),
+        'show': lambda: (f'/show/{show()}', {}),
+        'play': lambda: (f'/play/{show()}/{episode()}', {}),
+        'preview': lambda: (f'/preview/{show()}/{episode()}?t={random.uniform(0, seconds):.1f}', {}),
+        'sub': lambda: (f'/sub/{show()}/{srt()}', {'Accept-Encoding': 'gzip'}),
+        'poster_file': lambda: (f'/poster_file/{show()}/poster.jpg', {}),
+        'poster_thumb': lambda: (f'/poster_file/{show()}/poster.jpg?w=220&fmt=webp', {}),
+        'stream': stream,
+    }
+
+def run_scenario(base_url, make_request, requests, concurrency):
+    parts = urlsplit(base_url)
+    local = threading.local()
+
+    def one(_):
+        conn = getattr(local, 'conn', None)
+        if conn is None: conn = local.conn = http.client.HTTPConnection(parts.hostname, parts.port, timeout=60)
+        path, headers = make_request()
+        started = time.perf_counter()
+        try:
+            conn.request('GET', quote(BASE_PATH) + path, headers=headers)
+            response = conn.getresponse()
+            size = len(response.read())
+            status = response.status
+        except (OSError, http.client.HTTPException):
+            local.conn = None
+            conn.close()
+            return time.perf_counter() - started, 0, 0
+        return time.perf_counter() - started, status, size
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        results = list(pool.map(one, range(requests)))
+    wall = time.perf_counter() - started
+    latencies = sorted(r[0] for r in results)
+    pct = lambda q: round(latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000, 2)
+    statuses = {}
+    for _, status, _ in results: statuses[str(status)] = statuses.get(str(status), 0) + 1
+    return {
+        'requests': requests,
+        'concurrency': concurrency,
+        'p50_ms': pct(0.50), 'p95_ms': pct(0.95), 'p99_ms': pct(0.99),
+        'max_ms': round(latencies[-1] * 1000, 2),
+        'requests_per_sec': round(requests / wall, 1),
+        'mb_per_sec': round(sum(r[2] for r in results) / wall / 1e6, 2),
+        'statuses': statuses,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--mode', choices=['gunicorn', 'dev'], default='gunicorn', help='server to start (ignored with --url)')
+    parser.add_argument('--url', help='benchmark an already running server instead of starting one')
+    parser.add_argument('--library', help='reuse this library dir instead of generating a fresh one')
+    parser.add_argument('--shows', type=int, default=10)
+    parser.add_argument('--episodes', type=int, default=6)
+    parser.add_argument('--seconds', type=int, default=30, help='length of each synthetic episode')
+    parser.add_argument('--requests', type=int, default=300, help='requests per route')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--preview-workers', type=int, default=0, help='ANISUB_PREVIEW_WORKERS for the started server')
+    parser.add_argument('--routes', default='', help='comma-separated subset of routes to run')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default='bench_results.json')
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    workdir = tempfile.mkdtemp(prefix='anisub-bench-')
+    library = args.library or os.path.join(workdir, 'library')
+    proc = sampler = None
+    try:
+        if not args.library:
+            os.makedirs(library)
+            started = time.perf_counter()
+            generate_library(library, args.shows, args.episodes, args.seconds)
+            print(f'generated {args.shows}x{args.episodes} library in {time.perf_counter() - started:.1f}s')
+        base_url = args.url
+        if not base_url:
+            env = server_env(library, os.path.join(workdir, 'cache'), args.preview_workers)
+            cold = measure_import(env)
+            print(f"import app: {cold['import_sec']} s, {cold['import_rss_mb']} MB, cv2 loaded: {cold['cv2_loaded']}")
+            port = free_port()
+            started = time.perf_counter()
+            proc = start_server(args.mode, env, port)
+            startup = time.perf_counter() - started
+            base_url = f'http://127.0.0.1:{port}'
+            idle_rss = tree_rss(proc.pid)
+            sampler = RssSampler(proc.pid)
+            sampler.start()
+        scenarios = build_scenarios(args.shows, args.episodes, args.seconds)
+        if sampler:
+            # Cold first hits, before any warm-up: page render vs. first OpenCV use
+            first = {name: first_request_ms(base_url, scenarios[name]()[0]) for name in ('index', 'preview')}
+            print(f"first request: {first}")
+        selected = [r for r in args.routes.split(',') if r] or list(scenarios)
+        results = {}
+        for name in selected:
+            # A short warm-up so one-off work (index build, first decode) isn't in the numbers
+            run_scenario(base_url, scenarios[name], min(args.concurrency * 2, args.requests), args.concurrency)
+            results[name] = run_scenario(base_url, scenarios[name], args.requests, args.concurrency)
+            r = results[name]
+            print(f"{name:>12}: p50 {r['p50_ms']:8.2f} ms  p95 {r['p95_ms']:8.2f} ms  p99 {r['p99_ms']:8.2f} ms  "
+                  f"{r['requests_per_sec']:8.1f} req/s  {r['mb_per_sec']:7.2f} MB/s  {r['statuses']}")
+        report = {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'server': args.url or args.mode,
+            'python': platform.python_version(),
+            'library': {'shows': args.shows, 'episodes': args.episodes, 'seconds': args.seconds},
+            'routes': results,
+        }
+        if sampler:
+            sampler.running = False
+            sampler.join()
+            report.update(cold, preview_workers=args.preview_workers)
+            report['startup_sec'] = round(startup, 3)
+            report['first_request_ms'] = {name: ms for name, (ms, _) in first.items()}
+            report['idle_rss_mb'] = round(idle_rss / 1e6, 1)
+            report['peak_rss_mb'] = round(sampler.peak / 1e6, 1)
+            print(f"startup {report['startup_sec']} s, idle RSS {report['idle_rss_mb']} MB, peak RSS {report['peak_rss_mb']} MB")
+        with open(args.output, 'w') as f: json.dump(report, f, indent=2)
+        print(f'wrote {args.output}')
+    finally:
+        if proc:
+            proc.terminate()
+            try:
+                proc.wait(10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+        if not args.library: shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,19 @@
+import os
+
+# Production entry point: gunicorn -c gunicorn.conf.py app:app
+#
+# gthread workers keep long video responses from blocking short page, poster and
+# subtitle requests: each worker serves ANISUB_THREADS requests concurrently, video
+# bytes go out through os.sendfile, and open-ended ranges are capped
+# (ANISUB_STREAM_RANGE_CAP) so stream threads are released between chunks.
+bind = os.environ.get("ANISUB_BIND", "0.0.0.0:5000")
+workers = int(os.environ.get("ANISUB_WORKERS", 2))
+worker_class = "gthread"
+threads = int(os.environ.get("ANISUB_THREADS", 32))
+sendfile = True
+keepalive = 5
+# gthread heartbeats from the main thread, so this doesn't cut off long streams
+timeout = 60
+graceful_timeout = 30
+accesslog = "-"
+errorlog = "-"
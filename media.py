@@ -0,0 +1,183 @@
+# OpenCV work for app.py: seek previews, sprite sheets, poster thumbnails and probes.
+# cv2/numpy are imported inside the functions so that importing this module stays
+# cheap; app.py calls these either in-process or in preview worker processes
+# (ANISUB_PREVIEW_WORKERS), and only the process that decodes pays for OpenCV.
+import os
+import time
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
+
+# Preview decoder pool (per process)
+PREVIEW_POOL_SIZE = int(os.environ.get("ANISUB_PREVIEW_POOL_SIZE", 6))
+PREVIEW_IDLE_TIMEOUT = int(os.environ.get("ANISUB_PREVIEW_IDLE_TIMEOUT", 120))
+PREVIEW_WIDTH = 180
+
+class DecoderPool:
+    # One cv2.VideoCapture per file, checked out under a per-file lock so that
+    # concurrent hovers never seek/read the same capture at the same time.
+    def __init__(self, size, idle_timeout):
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # path -> {'cap', 'lock', 'last_used'}, LRU first
+        self.counters = {'hits': 0, 'misses': 0, 'waits': 0, 'evictions': 0}
+        self.sweeper = None
+
+    @contextmanager
+    def checkout(self, path):
+        import cv2
+        with self.lock:
+            self._sweep()
+            if self.sweeper is None:
+                # Idle captures are closed even if no further preview ever comes in
+                self.sweeper = threading.Thread(target=self.sweep_loop, name='preview-pool-sweep', daemon=True)
+                self.sweeper.start()
+            entry = self.entries.get(path)
+            if entry is None:
+                self.counters['misses'] += 1
+                entry = {'cap': None, 'lock': threading.Lock(), 'last_used': time.monotonic()}
+                self.entries[path] = entry
+            else:
+                self.counters['hits'] += 1
+                self.entries.move_to_end(path)
+        if not entry['lock'].acquire(blocking=False):
+            with self.lock: self.counters['waits'] += 1
+            entry['lock'].acquire()
+        try:
+            if entry['cap'] is None:
+                entry['cap'] = cv2.VideoCapture(path)
+            yield entry['cap']
+        finally:
+            entry['last_used'] = time.monotonic()
+            with self.lock:
+                # Evicted while we were waiting for it: don't leak the capture we reopened
+                if self.entries.get(path) is not entry and entry['cap'] is not None:
+                    entry['cap'].release()
+                    entry['cap'] = None
+                entry['lock'].release()
+                self._evict()
+
+    def sweep_loop(self):
+        while True:
+            time.sleep(max(1, self.idle_timeout / 4))
+            with self.lock: self._sweep()
+
+    def stats(self):
+        with self.lock:
+            self._sweep()
+            return dict(self.counters, size=len(self.entries), capacity=self.size)
+
+    def _release(self, path):
+        entry = self.entries.pop(path)
+        if entry['cap'] is not None: entry['cap'].release()
+        entry['cap'] = None
+        self.counters['evictions'] += 1
+
+    def _sweep(self):
+        now = time.monotonic()
+        for path, entry in list(self.entries.items()):
+            if now - entry['last_used'] > self.idle_timeout and entry['lock'].acquire(blocking=False):
+                try: self._release(path)
+                finally: entry['lock'].release()
+
+    def _evict(self):
+        # Least-recently-used first; captures that are checked out are skipped
+        for path, entry in list(self.entries.items()):
+            if len(self.entries) <= self.size: break
+            if entry['lock'].acquire(blocking=False):
+                try: self._release(path)
+                finally: entry['lock'].release()
+
+pool = DecoderPool(PREVIEW_POOL_SIZE, PREVIEW_IDLE_TIMEOUT)
+
+def pool_stats():
+    return dict(pool.stats(), pid=os.getpid())
+
+def render_preview(video_path, t):
+    # Returns (jpeg bytes or None, seconds spent per stage)
+    import cv2
+    timings = {}
+    with pool.checkout(video_path) as cap:
+        started = time.perf_counter()
+        cap.set(cv2.CAP_PROP_POS_MSEC, t * 1000)
+        success, frame = cap.read()
+        timings['decode'] = time.perf_counter() - started
+    if not success: return None, timings
+    started = time.perf_counter()
+    height, width = frame.shape[:2]
+    new_height = int(height * (PREVIEW_WIDTH / width))
+    resized = cv2.resize(frame, (PREVIEW_WIDTH, new_height), interpolation=cv2.INTER_AREA)
+    timings['resize'] = time.perf_counter() - started
+    started = time.perf_counter()
+    _, buffer = cv2.imencode('.jpg', resized, [cv2.IMWRITE_JPEG_QUALITY, 50])
+    timings['encode'] = time.perf_counter() - started
+    return buffer.tobytes(), timings
+
+def render_sprites(video_path, out_dir, interval, tile_width, cols, rows):
+    # Writes sprite_NNN.jpg sheets into out_dir and returns one
+    # (start, end, sheet_no, x, y, w, h) tuple per tile
+    import cv2
+    import numpy as np
+    cap = cv2.VideoCapture(video_path)
+    try:
+        fps = cap.get(cv2.CAP_PROP_FPS) or 0
+        frames = cap.get(cv2.CAP_PROP_FRAME_COUNT) or 0
+        duration = frames / fps if fps > 0 else 0
+        per_sheet = cols * rows
+        tiles, cues, sheet_no, t = [], [], 0, 0.0
+        tile_h = None
+
+        def flush():
+            nonlocal tiles, sheet_no
+            sheet = np.zeros((rows * tile_h, cols * tile_width, 3), np.uint8)
+            for i, tile in enumerate(tiles):
+                r, c = divmod(i, cols)
+                sheet[r * tile_h:(r + 1) * tile_h, c * tile_width:(c + 1) * tile_width] = tile
+            rows_used = (len(tiles) + cols - 1) // cols
+            cv2.imwrite(os.path.join(out_dir, f'sprite_{sheet_no:03d}.jpg'), sheet[:rows_used * tile_h], [cv2.IMWRITE_JPEG_QUALITY, 60])
+            tiles, sheet_no = [], sheet_no + 1
+
+        while duration <= 0 or t < duration:
+            cap.set(cv2.CAP_PROP_POS_MSEC, t * 1000)
+            success, frame = cap.read()
+            if not success: break
+            height, width = frame.shape[:2]
+            if tile_h is None: tile_h = max(1, int(height * (tile_width / width)))
+            tiles.append(cv2.resize(frame, (tile_width, tile_h), interpolation=cv2.INTER_AREA))
+            r, c = divmod(len(tiles) - 1, cols)
+            end = min(t + interval, duration) if duration > 0 else t + interval
+            cues.append((t, end, sheet_no, c * tile_width, r * tile_h, tile_width, tile_h))
+            if len(tiles) == per_sheet: flush()
+            t += interval
+        if tiles: flush()
+    finally:
+        cap.release()
+    return cues
+
+def resize_image(path, width, fmt):
+    # Poster thumbnail: encoded bytes no wider than width, or None if unreadable
+    import cv2
+    img = cv2.imread(path, cv2.IMREAD_COLOR)
+    if img is None: return None
+    height, src_width = img.shape[:2]
+    if src_width > width:
+        img = cv2.resize(img, (width, int(height * (width / src_width))), interpolation=cv2.INTER_AREA)
+    params = [cv2.IMWRITE_WEBP_QUALITY, 80] if fmt == 'webp' else [cv2.IMWRITE_JPEG_QUALITY, 85]
+    ok, buffer = cv2.imencode(f'.{fmt}', img, params)
+    return buffer.tobytes() if ok else None
+
+def probe_video(path):
+    import cv2
+    cap = cv2.VideoCapture(path)
+    try:
+        fps = cap.get(cv2.CAP_PROP_FPS) or 0
+        frames = cap.get(cv2.CAP_PROP_FRAME_COUNT) or 0
+        return {
+            'width': int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
+            'height': int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+            'duration': frames / fps if fps > 0 else 0,
+            'video_codec': (int(cap.get(cv2.CAP_PROP_FOURCC)) & 0xFFFFFFFF).to_bytes(4, 'little').decode('ascii', 'replace').strip('\x00 ') or None,
+        }
+    finally:
+        cap.release()
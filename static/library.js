@@ -0,0 +1,81 @@
+// Infinite scroll over /api/shows, and search over /api/search
+const grid = document.getElementById('showGrid');
+const sentinel = document.getElementById('gridSentinel');
+const browse = document.getElementById('libraryBrowse');
+const results = document.getElementById('searchResults');
+const searchBox = document.getElementById('librarySearch');
+
+function showCard(item) {
+    const card = document.createElement('a');
+    card.className = 'card';
+    card.href = item.url;
+    const picture = document.createElement('picture');
+    if (item.srcset_webp) {
+        const source = document.createElement('source');
+        source.type = 'image/webp'; source.srcset = item.srcset_webp; source.sizes = ANISUB.posterSizes;
+        picture.appendChild(source);
+    }
+    const img = document.createElement('img');
+    img.className = 'poster'; img.loading = 'lazy'; img.alt = 'Poster'; img.src = item.poster;
+    if (item.srcset) { img.srcset = item.srcset; img.sizes = ANISUB.posterSizes; }
+    picture.appendChild(img);
+    const title = document.createElement('div');
+    title.className = 'title'; title.textContent = item.name;
+    card.append(picture, title);
+    return card;
+}
+
+function episodeRow(item) {
+    const li = document.createElement('li');
+    const a = document.createElement('a');
+    a.href = item.url; a.textContent = `${item.show} · ${item.name}`;
+    li.appendChild(a);
+    return li;
+}
+
+// Library grid: the first page is server-rendered, later pages load near the bottom
+let nextCursor = sentinel.dataset.nextCursor, loading = false;
+async function loadMore() {
+    if (!nextCursor || loading) return;
+    loading = true;
+    try {
+        const res = await fetch(`${ANISUB.basePath}/api/shows?cursor=${encodeURIComponent(nextCursor)}`);
+        const page = await res.json();
+        page.items.forEach(item => grid.appendChild(showCard(item)));
+        nextCursor = page.next_cursor;
+    } finally {
+        loading = false;
+    }
+    if (nextCursor && sentinel.getBoundingClientRect().top < window.innerHeight + 800) loadMore();
+}
+new IntersectionObserver(entries => { if (entries[0].isIntersecting) loadMore(); }, { rootMargin: '800px' }).observe(sentinel);
+
+// Search: shows as cards, episodes as a list; "more" pages through the same cursor API
+let searchTimer = null, searchSeq = 0;
+searchBox.addEventListener('input', () => {
+    clearTimeout(searchTimer);
+    searchTimer = setTimeout(() => runSearch(searchBox.value.trim()), 200);
+});
+
+async function runSearch(q, cursor = null) {
+    const seq = ++searchSeq;
+    if (!q) { results.hidden = true; browse.hidden = false; return; }
+    const params = new URLSearchParams({ q });
+    if (cursor) params.set('cursor', cursor);
+    const page = await (await fetch(`${ANISUB.basePath}/api/search?${params}`)).json();
+    if (seq !== searchSeq) return;
+    if (!cursor) {
+        results.innerHTML = '<div class="grid"></div><ul class="episode-list"></ul>';
+        results.hidden = false; browse.hidden = true;
+    }
+    const [cards, episodes] = results.children;
+    results.querySelector('.more-btn')?.remove();
+    page.items.forEach(item => item.kind === 'show' ? cards.appendChild(showCard(item)) : episodes.appendChild(episodeRow(item)));
+    if (!cards.children.length && !episodes.children.length) episodes.innerHTML = '<li><a>No matches</a></li>';
+    if (page.next_cursor) {
+        const more = document.createElement('a');
+        more.className = 'back-btn more-btn'; more.href = '#'; more.textContent = 'MORE RESULTS';
+        more.onclick = (e) => { e.preventDefault(); runSearch(q, page.next_cursor); };
+        results.appendChild(more);
+    }
+}
@@ -0,0 +1,353 @@
+const video = document.getElementById('videoPlayer');
+const videoArea = document.getElementById('videoArea');
+const playIcon = document.getElementById('playIcon');
+const feedbackIcon = document.getElementById('feedbackIcon');
+const seekBar = document.getElementById('seekBar');
+const currTimeEl = document.getElementById('currTime'), currTimeMob = document.getElementById('currTimeMob');
+const totalTimeEl = document.getElementById('totalTime'), totalTimeMob = document.getElementById('totalTimeMob');
+const subSpan = document.getElementById('subSpan'), subText = document.getElementById('subText');
+const previewContainer = document.getElementById('previewContainer'), previewImg = document.getElementById('previewImg'), previewTime = document.getElementById('previewTime');
+const resSelect = document.getElementById('resSelect');
+
+let uiVisible = true;
+let uiTimeout = null;
+let clickTimer = null;
+let lastTapTime = 0;
+let currentSeekSum = 0;
+let seekResetTimer = null;
+
+function formatTime(sec) {
+    if (isNaN(sec)) return "0:00";
+    const h = Math.floor(sec / 3600), m = Math.floor((sec % 3600) / 60), s = Math.floor(sec % 60);
+    return h > 0 ? `${h}:${m.toString().padStart(2, '0')}:${s.toString().padStart(2, '0')}` : `${m}:${s.toString().padStart(2, '0')}`;
+}
+
+function showUI() {
+    uiVisible = true;
+    videoArea.classList.add('ui-on');
+    document.querySelectorAll('.ui-element').forEach(el => el.classList.remove('ui-hidden'));
+    resetTimer();
+}
+
+function hideUI() {
+    if (video.paused) return;
+    uiVisible = false;
+    videoArea.classList.remove('ui-on');
+    document.querySelectorAll('.ui-element').forEach(el => el.classList.add('ui-hidden'));
+}
+
+function resetTimer() {
+    if (uiTimeout) clearTimeout(uiTimeout);
+    if (!video.paused) uiTimeout = setTimeout(hideUI, 3000);
+}
+
+function forceUI(show) {
+    if (show) showUI(); else hideUI();
+}
+
+function handleGlobalClick(e) {
+    const now = Date.now();
+    const rect = videoArea.getBoundingClientRect();
+    const x = e.clientX - rect.left;
+    const y = e.clientY - rect.top;
+
+    if (clickTimer) clearTimeout(clickTimer);
+
+    if (now - lastTapTime < 300) {
+        lastTapTime = now;
+        if (x < rect.width * 0.4) triggerYouTubeSeek('L');
+        else if (x > rect.width * 0.6) triggerYouTubeSeek('R');
+        return;
+    }
+
+    lastTapTime = now;
+    clickTimer = setTimeout(() => {
+        const isCenter = x > rect.width * 0.35 && x < rect.width * 0.65 &&
+                       y > rect.height * 0.3 && y < rect.height * 0.7;
+
+        if (!uiVisible) {
+            showUI();
+        } else if (isCenter) {
+            togglePlay(true);
+        } else {
+            hideUI();
+        }
+    }, 250);
+}
+
+function updatePlayIcon() {
+    const path = video.paused ? 'M8 5v14l11-7z' : 'M6 19h4V5H6v14zm8-14v14h4V5h-4z';
+    const html = `<path d="${path}"/>`;
+    playIcon.innerHTML = html;
+    feedbackIcon.innerHTML = html;
+}
+
+function togglePlay(autoHide = false) {
+    if (video.paused) {
+        video.play();
+        if (autoHide) hideUI(); else resetTimer();
+    } else {
+        video.pause();
+        showUI();
+    }
+    updatePlayIcon();
+}
+
+function triggerYouTubeSeek(dir) {
+    if (seekResetTimer) clearTimeout(seekResetTimer);
+    currentSeekSum += 10;
+    const el = document.getElementById(dir === 'L' ? 'seekL' : 'seekR');
+    const txt = document.getElementById(dir === 'L' ? 'seekTextL' : 'seekTextR');
+    video.currentTime += (dir === 'L' ? -10 : 10);
+    txt.innerText = `${currentSeekSum} seconds`;
+    el.style.opacity = '1';
+    setTimeout(() => { el.style.opacity = '0'; }, 600);
+    seekResetTimer = setTimeout(() => { currentSeekSum = 0; }, 1000);
+    resetTimer();
+}
+
+// Watch progress and preferences live on the server so they follow the viewer across devices
+const progressShow = ANISUB.show, progressEp = ANISUB.episode;
+let resumeAt = ANISUB.resumeAt;
+let preferredRes = ANISUB.preferredRes || localStorage.getItem('anisub_preferred_res');
+let lastHeartbeat = 0;
+
+function setPreferredRes(res) {
+    preferredRes = res;
+    localStorage.setItem('anisub_preferred_res', res);
+    fetch(`${ANISUB.basePath}/api/preferences`, { method: 'POST', headers: { 'Content-Type': 'application/json' }, body: JSON.stringify({ preferred_res: res }) }).catch(() => {});
+}
+
+function sendProgress(beacon = false) {
+    if (!video.duration || isNaN(video.duration)) return;
+    lastHeartbeat = Date.now();
+    const body = JSON.stringify({ show: progressShow, episode: progressEp, position: video.currentTime, duration: video.duration });
+    if (beacon && navigator.sendBeacon) navigator.sendBeacon(`${ANISUB.basePath}/api/progress`, new Blob([body], { type: 'application/json' }));
+    else fetch(`${ANISUB.basePath}/api/progress`, { method: 'POST', headers: { 'Content-Type': 'application/json' }, body, keepalive: true }).catch(() => {});
+}
+
+// Past prefetchAt: the heartbeat makes the server warm the next episode's stream, and the
+// browser fetches its (small) page and subtitles at idle priority
+let prefetched = false;
+function prefetchNext() {
+    prefetched = true;
+    sendProgress();
+    for (const href of ANISUB.prefetchUrls) {
+        const link = document.createElement('link');
+        link.rel = 'prefetch'; link.href = href;
+        document.head.appendChild(link);
+    }
+}
+
+// Adaptive HLS (hls.js, or native on Safari); progressive /stream?res= otherwise
+const hlsUrl = `${ANISUB.basePath}/hls/${ANISUB.mediaPath}`;
+const hlsEnabled = ANISUB.hlsEnabled;
+let hls = null;
+function startHls() {
+    if (!hlsEnabled) return false;
+    if (!window.Hls || !Hls.isSupported()) {
+        if (!video.canPlayType('application/vnd.apple.mpegurl')) return false;
+        resSelect.innerHTML = '<option value="auto">Auto</option>';
+        video.src = hlsUrl;
+        return true;
+    }
+    hls = new Hls({ startPosition: 0 });
+    hls.on(Hls.Events.MANIFEST_PARSED, (ev, data) => {
+        const prefRes = preferredRes || 'auto';
+        resSelect.innerHTML = '<option value="auto">Auto</option>' +
+            data.levels.map((l, i) => `<option value="${i}">${l.height}p</option>`).join('');
+        const pref = data.levels.findIndex(l => `${l.height}p` === prefRes);
+        if (pref >= 0) { hls.startLevel = pref; hls.currentLevel = pref; resSelect.value = pref; }
+    });
+    hls.on(Hls.Events.ERROR, (ev, data) => {
+        if (!data.fatal) return;
+        // Packaging unavailable for this episode: fall back to progressive streaming
+        hls.destroy(); hls = null;
+        resSelect.innerHTML = `<option value="original">Orig</option>` +
+            ANISUB.availableRes.map(r => `<option value="${r}">${r}</option>`).join('');
+        startProgressive();
+    });
+    hls.loadSource(hlsUrl);
+    hls.attachMedia(video);
+    return true;
+}
+
+function startProgressive() {
+    const prefRes = preferredRes || '720p';
+    if (Array.from(resSelect.options).some(opt => opt.value === prefRes)) {
+        resSelect.value = prefRes;
+        video.src = `${ANISUB.basePath}/stream/${ANISUB.mediaPath}?res=${prefRes}`;
+    } else {
+        video.src = `${ANISUB.basePath}/stream/${ANISUB.mediaPath}`;
+    }
+}
+
+function changeResolution(res) {
+    if (hls) {
+        // Switches at the next segment boundary without flushing the buffer
+        hls.nextLevel = res === 'auto' ? -1 : parseInt(res);
+        if (res === 'auto') hls.currentLevel = -1;
+        setPreferredRes(res === 'auto' ? 'auto' : `${hls.levels[res].height}p`);
+        return;
+    }
+    if (res === 'auto') return;
+    const currentTime = video.currentTime;
+    const isPaused = video.paused;
+    setPreferredRes(res);
+    video.src = `${ANISUB.basePath}/stream/${ANISUB.mediaPath}?res=${res}`;
+    video.load();
+    video.onloadedmetadata = () => {
+        video.currentTime = currentTime;
+        if (!isPaused) video.play();
+    };
+}
+
+function updatePreview(val) {
+    const targetTime = (val / 100) * video.duration;
+    previewTime.innerText = formatTime(targetTime);
+    previewContainer.style.left = val + "%";
+    loadPreviewFrame(targetTime);
+}
+
+// Sprite-sheet thumbnails (WebVTT index), with /preview as fallback while they are generated
+const previewCanvas = document.getElementById('previewCanvas');
+let thumbCues = null;
+const spriteImgs = {};
+function loadThumbTrack(retries = 5) {
+    fetch(`${ANISUB.basePath}/thumbs/${ANISUB.mediaPath}`).then(r => {
+        if (!r.ok) { if (retries > 0) setTimeout(() => loadThumbTrack(retries - 1), 15000); return null; }
+        return r.text();
+    }).then(text => {
+        if (!text) return;
+        const cues = [];
+        for (const block of text.split(/\n\n+/)) {
+            const m = block.match(/([\d:.]+) --> ([\d:.]+)\n(\S+)#xywh=(\d+),(\d+),(\d+),(\d+)/);
+            if (!m) continue;
+            const toSec = v => v.split(':').reduce((a, b) => a * 60 + parseFloat(b), 0);
+            cues.push({ start: toSec(m[1]), end: toSec(m[2]), url: m[3], x: +m[4], y: +m[5], w: +m[6], h: +m[7] });
+            if (!spriteImgs[m[3]]) { spriteImgs[m[3]] = new Image(); spriteImgs[m[3]].src = m[3]; }
+        }
+        if (cues.length) thumbCues = cues;
+    }).catch(() => {});
+}
+
+function drawThumb(time) {
+    if (!thumbCues) return false;
+    const cue = thumbCues.find(c => time >= c.start && time < c.end) || thumbCues[thumbCues.length - 1];
+    const img = spriteImgs[cue.url];
+    if (!img || !img.complete || !img.naturalWidth) return false;
+    previewCanvas.width = cue.w; previewCanvas.height = cue.h;
+    previewCanvas.getContext('2d').drawImage(img, cue.x, cue.y, cue.w, cue.h, 0, 0, cue.w, cue.h);
+    previewCanvas.style.display = 'block'; previewImg.style.display = 'none';
+    return true;
+}
+
+let isPreviewLoading = false, pendingPreviewTime = null;
+function loadPreviewFrame(time) {
+    if (!isNaN(time) && drawThumb(time)) return;
+    previewCanvas.style.display = 'none'; previewImg.style.display = '';
+    if (isNaN(time) || isPreviewLoading) { pendingPreviewTime = time; return; }
+    isPreviewLoading = true;
+    const url = `${ANISUB.basePath}/preview/${ANISUB.mediaPath}?t=${time}`;
+    const img = new Image();
+    img.onload = () => {
+        previewImg.src = url; isPreviewLoading = false;
+        if (pendingPreviewTime) { let t = pendingPreviewTime; pendingPreviewTime = null; loadPreviewFrame(t); }
+    };
+    img.onerror = () => { isPreviewLoading = false; };
+    img.src = url;
+}
+
+function handleHover(e) {
+    const rect = seekBar.getBoundingClientRect();
+    const x = (e.touches ? e.touches[0].clientX : e.clientX) - rect.left;
+    updatePreview(Math.min(Math.max(0, x / rect.width), 1) * 100);
+}
+
+function showPreview() { previewContainer.style.display = 'flex'; }
+function hidePreview() { setTimeout(() => { previewContainer.style.display = 'none'; }, 100); }
+function manualSeek(val) { video.currentTime = (val / 100) * video.duration; resetTimer(); }
+function toggleCC() { if (video.textTracks.length) selectSubtitle(activeSub >= 0 ? -1 : Math.max(lastSub, 0)); }
+
+function toggleFullScreen() {
+    if (!document.fullscreenElement) {
+        if (videoArea.requestFullscreen) videoArea.requestFullscreen();
+        else if (video.webkitEnterFullscreen) video.webkitEnterFullscreen();
+    } else document.exitFullscreen();
+}
+
+video.addEventListener('timeupdate', () => {
+    seekBar.value = (video.currentTime / video.duration) * 100 || 0;
+    const f = formatTime(video.currentTime);
+    currTimeEl.innerText = currTimeMob.innerText = f;
+    if (!video.paused && Date.now() - lastHeartbeat > 10000) sendProgress();
+    if (!prefetched && ANISUB.prefetchAt > 0 && video.currentTime >= video.duration * ANISUB.prefetchAt) prefetchNext();
+});
+video.addEventListener('pause', () => sendProgress());
+window.addEventListener('pagehide', () => sendProgress(true));
+
+video.addEventListener('loadedmetadata', () => {
+    const f = formatTime(video.duration);
+    totalTimeEl.innerText = totalTimeMob.innerText = f;
+    // Resume only once; later metadata loads (resolution switches) restore their own position
+    if (resumeAt > 0 && resumeAt < video.duration - 5) video.currentTime = resumeAt;
+    resumeAt = 0;
+    updatePlayIcon();
+    resetTimer();
+});
+
+window.addEventListener('DOMContentLoaded', () => {
+    if (!startHls()) startProgressive();
+    updatePlayIcon();
+    loadThumbTrack();
+});
+
+// Subtitle tracks (sidecar SRT and extracted embedded tracks) are rendered by customSubs;
+// the selected one is 'hidden' so its cues still fire, the rest are disabled
+const subSelect = document.getElementById('subSelect');
+let activeSub = -1, lastSub = -1;
+function selectSubtitle(i) {
+    activeSub = i;
+    if (i >= 0) lastSub = i;
+    subSpan.innerText = "";
+    Array.from(video.textTracks).forEach((t, n) => {
+        t.mode = n === i ? 'hidden' : 'disabled';
+        t.oncuechange = n === i ? function() {
+            if (this.activeCues?.length > 0) subSpan.innerText = subText.innerText = this.activeCues[0].text;
+            else subSpan.innerText = "";
+        } : null;
+    });
+    subSelect.value = i;
+}
+const defaultSub = Array.from(video.querySelectorAll('track')).findIndex(t => t.default);
+selectSubtitle(video.textTracks.length ? Math.max(defaultSub, 0) : -1);
+
+// Embedded tracks are extracted in the background; pick them up once they are ready
+function loadSubtitleTracks(retries = 8) {
+    fetch(`${ANISUB.basePath}/subtitle_tracks/${ANISUB.mediaPath}`).then(r => r.ok ? r.json() : null).then(data => {
+        if (!data) return;
+        const known = new Set(Array.from(video.querySelectorAll('track')).map(t => t.getAttribute('src')));
+        data.tracks.filter(t => !known.has(t.src)).forEach(t => {
+            const el = document.createElement('track');
+            el.kind = 'subtitles'; el.src = t.src; el.label = t.label;
+            if (t.language) el.srclang = t.language;
+            video.appendChild(el);
+            subSelect.add(new Option(t.label, video.textTracks.length - 1));
+        });
+        if (activeSub < 0 && lastSub < 0 && video.textTracks.length) selectSubtitle(0);
+        else selectSubtitle(activeSub);
+        if (data.pending && retries > 0) setTimeout(() => loadSubtitleTracks(retries - 1), 15000);
+    }).catch(() => {});
+}
+if (ANISUB.subtitlesPending) setTimeout(loadSubtitleTracks, 5000);
+
+document.addEventListener('keydown', (e) => {
+    if (e.target.tagName === 'INPUT' || e.target.tagName === 'SELECT') return;
+    showUI();
+    switch (e.key) {
+        case 'ArrowLeft': e.preventDefault(); triggerYouTubeSeek('L'); break;
+        case 'ArrowRight': e.preventDefault(); triggerYouTubeSeek('R'); break;
+        case ' ': e.preventDefault(); togglePlay(); break;
+        case 'f': e.preventDefault(); toggleFullScreen(); break;
+     }
+});